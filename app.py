@@ -1,12 +1,27 @@
 import os
+import google.api_core.exceptions
 import google.generativeai as genai
-from flask import Flask, request, jsonify, render_template, redirect, url_for, abort, session, flash
-from PIL import Image
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, abort, session, flash, stream_with_context
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
+import bisect
+import copy
+import hashlib
+import io
 import json
+import math
+import random
+import re
 import requests
+import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 # NEW: Import security tools for password hashing
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -17,9 +32,47 @@ app = Flask(__name__)
 # CRITICAL: Flask sessions and flash messages require a secret key
 app.secret_key = 'your_super_secret_key_here' 
 
-# --- New User/Scan Data Structure (Centralized Database Mock) ---
-# USERS: {username: {id: str, password_hash: str, scans: {scan_id: scan_data}}}
-USERS = {}
+# --- User/Scan Storage ---
+# Accounts and scans live behind a storage backend (see the STORAGE section below):
+# "sqlite" is durable and shared by all gunicorn workers, "memory" is for tests.
+os.makedirs(app.instance_path, exist_ok=True)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATABASE_PATH = os.getenv("DATABASE_PATH", os.path.join(app.instance_path, "cookai.sqlite3"))
+# Scan history is paginated with a timestamp cursor (?before=<timestamp>&limit=<n>)
+SCAN_PAGE_SIZE = int(os.getenv("SCAN_PAGE_SIZE", "20"))
+SCAN_PAGE_MAX = 100
+
+# Job mode for /analyze: a bounded pool of background workers per gunicorn worker
+ANALYSIS_JOB_WORKERS = int(os.getenv("ANALYSIS_JOB_WORKERS", "4"))
+ANALYSIS_JOB_QUEUE_LIMIT = int(os.getenv("ANALYSIS_JOB_QUEUE_LIMIT", "16"))
+ANALYSIS_JOB_RETRY_AFTER_SECONDS = int(os.getenv("ANALYSIS_JOB_RETRY_AFTER_SECONDS", "10"))
+ANALYSIS_JOB_TTL_SECONDS = int(os.getenv("ANALYSIS_JOB_TTL_SECONDS", str(24 * 3600)))
+# Workers mark their queued and running jobs alive this often; a job missing
+# three heartbeats belonged to a worker that exited and is marked failed
+ANALYSIS_JOB_HEARTBEAT_SECONDS = float(os.getenv("ANALYSIS_JOB_HEARTBEAT_SECONDS", "10"))
+ANALYSIS_JOB_ORPHANED_AFTER_SECONDS = ANALYSIS_JOB_HEARTBEAT_SECONDS * 3
+
+# Shared guard rails for every Gemini call (see the GEMINI CLIENT section)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+GEMINI_LIMITER_MAX_WAIT_SECONDS = float(os.getenv("GEMINI_LIMITER_MAX_WAIT_SECONDS", "10"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "0.5"))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "8"))
+GEMINI_DEADLINE_SECONDS = float(os.getenv("GEMINI_DEADLINE_SECONDS", "60"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN_SECONDS = float(os.getenv("GEMINI_BREAKER_COOLDOWN_SECONDS", "30"))
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", os.path.join(app.instance_path, "rate_limits.sqlite3"))
+
+# Server-side chat conversations (see the CHAT SESSIONS section)
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "3000"))
+CHAT_KEEP_RECENT_TURNS = int(os.getenv("CHAT_KEEP_RECENT_TURNS", "4"))
+CHAT_CONVERSATION_TTL_SECONDS = int(os.getenv("CHAT_CONVERSATION_TTL_SECONDS", str(7 * 24 * 3600)))
+CHAT_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CHAT_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+CHAT_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CHAT_CLIENT_CACHE_ENTRIES = int(os.getenv("CHAT_CLIENT_CACHE_ENTRIES", "256"))
+# Files uploaded through the Gemini File API are kept for 48 hours
+GEMINI_FILE_TTL_SECONDS = 47 * 3600
 
 # --- Localization/Translation Data ---
 TRANSLATIONS = {
@@ -115,6 +168,35 @@ genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 # PEXELS Configuration
 PEXELS_API_KEY = os.getenv("PEXELS_API_KEY")
 PEXELS_URL = "https://api.pexels.com/v1/search"
+# Image lookups run in parallel over one keep-alive session; a reply waits at most
+# PEXELS_TIMEOUT_SECONDS for all of them together
+PEXELS_MAX_WORKERS = int(os.getenv("PEXELS_MAX_WORKERS", "4"))
+PEXELS_TIMEOUT_SECONDS = float(os.getenv("PEXELS_TIMEOUT_SECONDS", "4"))
+
+pexels_session = requests.Session()
+pexels_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=PEXELS_MAX_WORKERS))
+image_lookup_pool = ThreadPoolExecutor(max_workers=PEXELS_MAX_WORKERS, thread_name_prefix="pexels")
+
+# Query -> image URL cache, stored in SQLite so it survives restarts and is shared by all workers
+IMAGE_CACHE_PATH = os.getenv("IMAGE_CACHE_PATH", os.path.join(app.instance_path, "image_cache.sqlite3"))
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "5000"))
+IMAGE_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+IMAGE_CACHE_NEGATIVE_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_NEGATIVE_TTL_SECONDS", str(6 * 3600)))
+NO_IMAGE_FOUND_URL = "https://placehold.co/600x400?text=No+Image+Found"
+
+# /analyze results, keyed by image fingerprint + language + units
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "256"))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Max Hamming distance between perceptual hashes for two photos to count as the same
+ANALYSIS_CACHE_PHASH_DISTANCE = int(os.getenv("ANALYSIS_CACHE_PHASH_DISTANCE", "4"))
+
+# Uploaded photos are downsized and re-encoded before they are sent to Gemini
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# Let Pillow itself refuse decompression bombs above our limit
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
 
 # --- Gemini Configuration ---
 generation_config = {
@@ -132,7 +214,7 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
-model = genai.GenerativeModel(
+recipe_gemini_model = genai.GenerativeModel(
     model_name="gemini-2.5-flash",
     safety_settings=safety_settings,
     generation_config=generation_config,
@@ -140,21 +222,41 @@ model = genai.GenerativeModel(
     system_instruction="""
     You are CookAI. Analyze the image provided to identify ingredients and suggest 2 distinct recipes.
     
-    You must return the response in this specific JSON format:
+    You must return the response as a JSON array of recipe objects, with the keys in this order:
     [
         {
             "title": "Recipe Name",
             "description": "Short description",
             "ingredients": ["List", "of", "ingredients"],
             "instructions": ["Step 1", "Step 2"],
-            "time_minutes": 45,       // NEW: Total time in minutes
-            "skill_level": "Medium",  // NEW: Must be 'Easy', 'Medium', or 'Hard'
-            "image_url": "temporary_placeholder_will_be_overwritten"
+            "time_minutes": 45,
+            "skill_level": "Medium"
         }
     ]
+    "time_minutes" is the total time in minutes as a whole number.
+    "skill_level" must be exactly "Easy", "Medium" or "Hard".
+    Return only the JSON array, with no comments or extra text.
     """
 )
 
+# Structured output schema for the recipe list (OpenAPI subset understood by Gemini)
+RECIPE_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string"},
+            "description": {"type": "string"},
+            "ingredients": {"type": "array", "items": {"type": "string"}},
+            "instructions": {"type": "array", "items": {"type": "string"}},
+            "time_minutes": {"type": "integer"},
+            "skill_level": {"type": "string", "enum": ["Easy", "Medium", "Hard"]},
+        },
+        "required": ["title", "description", "ingredients", "instructions", "time_minutes", "skill_level"],
+    },
+}
+SKILL_LEVELS = ("Easy", "Medium", "Hard")
+
 # --- Separate model for open-ended cooking chat (text + optional image) ---
 chat_generation_config = {
     "temperature": 0.7,
@@ -164,23 +266,730 @@ chat_generation_config = {
     "response_mime_type": "text/plain",
 }
 
-chat_model = genai.GenerativeModel(
+CHAT_SYSTEM_INSTRUCTION = (
+    "You are CookAI Chat, a friendly expert cooking assistant. "
+    "Answer questions about cooking, ingredients, substitutions, techniques, food safety, and recipes. "
+    "If the user provides a past scan, use it as context. "
+    "Be concise, practical, and give step-by-step instructions when appropriate. "
+    "If the user uploads an image, describe what you see and suggest what to cook or how to improve the dish." 
+)
+
+chat_gemini_model = genai.GenerativeModel(
     model_name="gemini-2.5-flash",
     safety_settings=safety_settings,
     generation_config=chat_generation_config,
-    system_instruction=(
-        "You are CookAI Chat, a friendly expert cooking assistant. "
-        "Answer questions about cooking, ingredients, substitutions, techniques, food safety, and recipes. "
-        "If the user provides a past scan, use it as context. "
-        "Be concise, practical, and give step-by-step instructions when appropriate. "
-        "If the user uploads an image, describe what you see and suggest what to cook or how to improve the dish." 
-    ),
+    system_instruction=CHAT_SYSTEM_INSTRUCTION,
+)
+
+# -----------------------------------------------------
+# --- STORAGE ---
+# -----------------------------------------------------
+
+def open_sqlite(path):
+    """Opens a SQLite connection tuned for several processes sharing one file."""
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+
+class MemoryStore:
+    """Keeps users and scans in a process-local dict. Only suitable for tests.
+
+    Layout: {username: {id: str, password_hash: str, scans: {scan_id: scan_data},
+                        history: [(timestamp, scan_id), ...] oldest first}}
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.jobs = {}
+        self.conversations = {}
+        self._lock = threading.Lock()
+
+    def get_user(self, username):
+        user = self.users.get(username)
+        if user is None:
+            return None
+        return {"username": username, "id": user["id"], "password_hash": user["password_hash"]}
+
+    def create_user(self, username, user_id, password_hash):
+        """Adds a user. Returns False if the username is already taken."""
+        with self._lock:
+            if username in self.users:
+                return False
+            self.users[username] = {"id": user_id, "password_hash": password_hash, "scans": {}, "history": []}
+            return True
+
+    def add_scan(self, username, scan_id, scan):
+        with self._lock:
+            user = self.users[username]
+            user["scans"][scan_id] = dict(scan, id=scan_id)
+            # Scans almost always arrive in time order, so this is an append
+            bisect.insort(user["history"], (scan["timestamp"], scan_id))
+
+    def get_scan(self, username, scan_id):
+        user = self.users.get(username)
+        if user is None:
+            return None
+        return user["scans"].get(scan_id)
+
+    def list_scans(self, username, before=None, limit=SCAN_PAGE_SIZE):
+        """Returns up to `limit` scans before the (timestamp, id) `before`, newest first."""
+        user = self.users.get(username)
+        if user is None:
+            return []
+        history = user["history"]
+        end = len(history) if before is None else bisect.bisect_left(history, tuple(before))
+        page = history[max(0, end - limit):end]
+        return [user["scans"][scan_id] for _, scan_id in reversed(page)]
+
+    def count_scans(self, username):
+        user = self.users.get(username)
+        return len(user["scans"]) if user else 0
+
+    def create_job(self, job_id, username):
+        with self._lock:
+            now = time.time()
+            self.jobs = {
+                other_id: job for other_id, job in self.jobs.items()
+                if now - job["created_at"] < ANALYSIS_JOB_TTL_SECONDS
+            }
+            self.jobs[job_id] = {
+                "id": job_id, "username": username, "status": "queued", "created_at": now,
+                "started_at": None, "finished_at": None, "result": None, "error": None, "heartbeat_at": now,
+            }
+
+    def update_job(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def touch_jobs(self, job_ids):
+        with self._lock:
+            now = time.time()
+            for job_id in job_ids:
+                if job_id in self.jobs:
+                    self.jobs[job_id]["heartbeat_at"] = now
+
+    def fail_orphaned_jobs(self, stale_before, error, job_id=None):
+        with self._lock:
+            now = time.time()
+            failed = 0
+            for job in self.jobs.values():
+                if job_id not in (None, job["id"]):
+                    continue
+                if job["status"] in ("queued", "running") and job["heartbeat_at"] < stale_before:
+                    job.update(status="error", finished_at=now, error=error)
+                    failed += 1
+            return failed
+
+    def get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        return dict(job) if job else None
+
+    def get_conversation(self, conversation_id):
+        conversation = self.conversations.get(conversation_id)
+        return copy.deepcopy(conversation) if conversation else None
+
+    def save_conversation(self, conversation):
+        with self._lock:
+            now = time.time()
+            self.conversations = {
+                other_id: other for other_id, other in self.conversations.items()
+                if now - other["updated_at"] < CHAT_CONVERSATION_TTL_SECONDS
+            }
+            self.conversations[conversation["id"]] = copy.deepcopy(dict(conversation, updated_at=now))
+
+
+class SQLiteStore:
+    """Users and scans in a SQLite database in WAL mode.
+
+    Every gunicorn worker opens the same file, so a login on one worker sees
+    scans saved by another. Each thread gets its own connection; concurrent
+    writers are serialized by SQLite's lock (waiting up to busy_timeout).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                password_hash TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                scan_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS scans (
+                id TEXT PRIMARY KEY,
+                username TEXT NOT NULL REFERENCES users (username),
+                timestamp REAL NOT NULL,
+                date TEXT NOT NULL,
+                summary_title TEXT,
+                summary_notes TEXT,
+                summary_image TEXT,
+                recipes TEXT NOT NULL
+            );
+            DROP INDEX IF EXISTS scans_user_timestamp;
+            CREATE INDEX IF NOT EXISTS scans_user_timestamp_id ON scans (username, timestamp, id);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                username TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                result TEXT,
+                error TEXT,
+                heartbeat_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+            CREATE TABLE IF NOT EXISTS chat_conversations (
+                id TEXT PRIMARY KEY,
+                username TEXT,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chat_conversations_updated_at ON chat_conversations (updated_at);
+        """)
+        self._migrate()
+
+    def _migrate(self):
+        conn = self._connection()
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+        if "scan_count" not in columns:
+            with self._transaction() as conn:
+                conn.execute("ALTER TABLE users ADD COLUMN scan_count INTEGER NOT NULL DEFAULT 0")
+                conn.execute(
+                    "UPDATE users SET scan_count = (SELECT COUNT(*) FROM scans WHERE scans.username = users.username)"
+                )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_sqlite(self.path)
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _scan_from_row(row):
+        scan = dict(row)
+        scan.pop("username", None)
+        if "recipes" in scan:
+            scan["recipes"] = json.loads(scan["recipes"])
+        return scan
+
+    def get_user(self, username):
+        row = self._connection().execute(
+            "SELECT username, id, password_hash FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def create_user(self, username, user_id, password_hash):
+        """Adds a user. Returns False if the username is already taken."""
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO users (username, id, password_hash, created_at) VALUES (?, ?, ?, ?)",
+            (username, user_id, password_hash, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    def add_scan(self, username, scan_id, scan):
+        with self._transaction() as conn:
+            conn.execute(
+                """INSERT INTO scans (id, username, timestamp, date, summary_title, summary_notes, summary_image, recipes)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    scan_id, username, scan["timestamp"], scan["date"],
+                    scan["summary_title"], scan["summary_notes"], scan["summary_image"],
+                    json.dumps(scan["recipes"], ensure_ascii=False),
+                ),
+            )
+            # Kept alongside the scans so the account page never has to count them
+            conn.execute("UPDATE users SET scan_count = scan_count + 1 WHERE username = ?", (username,))
+
+    def get_scan(self, username, scan_id):
+        row = self._connection().execute(
+            "SELECT * FROM scans WHERE username = ? AND id = ?", (username, scan_id)
+        ).fetchone()
+        return self._scan_from_row(row) if row else None
+
+    def list_scans(self, username, before=None, limit=SCAN_PAGE_SIZE):
+        """Returns up to `limit` scans (without recipe bodies) before the (timestamp, id) `before`, newest first.
+
+        Served straight from the (username, timestamp, id) index, so the cost
+        of a page doesn't depend on how long the history is. The id breaks
+        ties, so scans saved in the same instant never fall between pages.
+        """
+        rows = self._connection().execute(
+            """SELECT id, timestamp, date, summary_title, summary_notes, summary_image
+               FROM scans WHERE username = ? AND (timestamp, id) < (?, ?)
+               ORDER BY timestamp DESC, id DESC LIMIT ?""",
+            (username, *(before or (float("inf"), "")), limit),
+        ).fetchall()
+        return [self._scan_from_row(row) for row in rows]
+
+    def count_scans(self, username):
+        row = self._connection().execute(
+            "SELECT scan_count FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def create_job(self, job_id, username):
+        # Jobs live in the database so any worker can answer a status poll
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM jobs WHERE created_at < ?", (now - ANALYSIS_JOB_TTL_SECONDS,))
+            conn.execute(
+                "INSERT INTO jobs (id, username, status, created_at, heartbeat_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, username, now, now),
+            )
+
+    def update_job(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        self._connection().execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+        )
+
+    def touch_jobs(self, job_ids):
+        job_ids = list(job_ids)
+        if job_ids:
+            self._connection().execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE id IN ({', '.join('?' * len(job_ids))})",
+                (time.time(), *job_ids),
+            )
+
+    def fail_orphaned_jobs(self, stale_before, error, job_id=None):
+        """Marks queued or running jobs whose heartbeat is older than `stale_before` failed."""
+        query = """UPDATE jobs SET status = 'error', finished_at = ?, error = ?
+                   WHERE status IN ('queued', 'running') AND heartbeat_at < ?"""
+        params = [time.time(), error, stale_before]
+        if job_id is not None:
+            query += " AND id = ?"
+            params.append(job_id)
+        return self._connection().execute(query, params).rowcount
+
+    def get_job(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        if job["result"]:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def get_conversation(self, conversation_id):
+        row = self._connection().execute(
+            "SELECT data FROM chat_conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def save_conversation(self, conversation):
+        now = time.time()
+        conversation = dict(conversation, updated_at=now)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM chat_conversations WHERE updated_at < ?", (now - CHAT_CONVERSATION_TTL_SECONDS,))
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_conversations (id, username, updated_at, data) VALUES (?, ?, ?, ?)",
+                (conversation["id"], conversation["username"], now, json.dumps(conversation, ensure_ascii=False)),
+            )
+
+
+def make_store(backend=STORAGE_BACKEND):
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(DATABASE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+store = make_store()
+
+# -----------------------------------------------------
+# --- GEMINI CLIENT ---
+# -----------------------------------------------------
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling Gemini while it is unhealthy or over quota."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SharedTokenBucket:
+    """Token buckets kept in SQLite so every gunicorn worker draws from the same budget."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_sqlite(self.path)
+        return conn
+
+    def _take(self, name, amount, capacity, per_second):
+        """Takes `amount` tokens if available. Returns 0, or the seconds until they will be."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (name,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * per_second)
+            # A request bigger than the whole bucket may still go once the bucket is full
+            needed = min(amount, capacity)
+            wait_seconds = 0.0 if tokens >= needed else (needed - tokens) / per_second
+            if wait_seconds == 0.0:
+                tokens -= amount
+            conn.execute(
+                "INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (name, tokens, now),
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return wait_seconds
+
+    def acquire(self, name, amount, per_minute, max_wait):
+        """Blocks until `amount` tokens are taken. Returns the time waited.
+
+        Raises UpstreamUnavailable if that would take longer than max_wait.
+        """
+        per_second = per_minute / 60.0
+        waited = 0.0
+        while True:
+            wait_seconds = self._take(name, amount, per_minute, per_second)
+            if wait_seconds == 0.0:
+                return waited
+            if waited + wait_seconds > max_wait:
+                raise UpstreamUnavailable("Gemini rate limit reached. Please try again shortly.", retry_after=wait_seconds)
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    def adjust(self, name, amount, per_minute):
+        """Charges (or refunds, if negative) tokens after the fact; the bucket may go into debt."""
+        conn = self._connection()
+        conn.execute(
+            "UPDATE token_buckets SET tokens = MIN(?, tokens - ?) WHERE name = ?",
+            (per_minute, amount, name),
+        )
+
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream errors, then lets one probe call through."""
+
+    def __init__(self, threshold, cooldown_seconds):
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.cooldown_seconds:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        """Raises UpstreamUnavailable while open. Returns True if this call is the half-open probe.
+
+        A probe must end in record_success(), record_failure() or, if it never
+        reached the upstream, release_probe().
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half_open" and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            retry_after = max(1.0, self.cooldown_seconds - (time.time() - self.opened_at))
+            raise UpstreamUnavailable(
+                "The AI service is temporarily unavailable. Please try again shortly.", retry_after=retry_after
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def release_probe(self):
+        """The probe was refused locally or cancelled: lets the next call probe instead."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.probe_in_flight or self.consecutive_failures >= self.threshold:
+                if self.opened_at is None or self.probe_in_flight:
+                    self.times_opened += 1
+                self.opened_at = time.time()
+            self.probe_in_flight = False
+
+
+RETRYABLE_GEMINI_ERRORS = (
+    google.api_core.exceptions.ResourceExhausted,
+    google.api_core.exceptions.TooManyRequests,
+    google.api_core.exceptions.ServiceUnavailable,
+    google.api_core.exceptions.InternalServerError,
+    google.api_core.exceptions.DeadlineExceeded,
+    google.api_core.exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
 )
 
+
+def estimate_tokens(contents):
+    """Rough input token count: ~4 characters per token, 258 tokens per image."""
+    total = 0
+    for part in contents if isinstance(contents, (list, tuple)) else [contents]:
+        if isinstance(part, str):
+            total += len(part) // 4 + 1
+        elif isinstance(part, dict) and "parts" in part:
+            # A {"role", "parts"} turn of a multi-turn conversation
+            total += estimate_tokens(part["parts"])
+        elif isinstance(part, dict) and "text" in part:
+            total += len(part["text"]) // 4 + 1
+        else:
+            total += 258
+    return total
+
+
+class GeminiClient:
+    """Wraps a GenerativeModel with the shared limiter, retries, deadlines and breaker.
+
+    Exposes the same generate_content() call as the model, so call sites don't change.
+    """
+
+    stats_lock = threading.Lock()
+    totals = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "limiter_wait_s": 0.0, "limiter_max_wait_s": 0.0}
+
+    def __init__(self, name, model, limiter, breaker):
+        self.name = name
+        self.model = model
+        self.limiter = limiter
+        self.breaker = breaker
+
+    @classmethod
+    def _count(cls, **increments):
+        with cls.stats_lock:
+            for key, value in increments.items():
+                cls.totals[key] += value
+
+    def generate_content(self, contents, stream=False, deadline=GEMINI_DEADLINE_SECONDS, **kwargs):
+        started = time.monotonic()
+        estimated = estimate_tokens(contents)
+
+        attempt = 0
+        while True:
+            # Every attempt is a request upstream, so every attempt takes its tokens
+            probe = self._admit(estimated, started, deadline)
+            remaining = deadline - (time.monotonic() - started)
+            self._count(calls=1)
+            try:
+                response = self.model.generate_content(
+                    contents, stream=stream, request_options={"timeout": max(1.0, remaining)}, **kwargs
+                )
+            except Exception as e:
+                time.sleep(self._backoff_or_raise(e, attempt, started, deadline))
+                attempt += 1
+                continue
+            except BaseException:
+                self._release(probe)
+                raise
+            if stream:
+                return GeminiStream(self, response, estimated, probe)
+            self._accept(response, estimated)
+            return response
+
+    def _limiter_budget(self, started, deadline):
+        return min(GEMINI_LIMITER_MAX_WAIT_SECONDS, deadline - (time.monotonic() - started))
+
+    def _admit(self, estimated, started, deadline):
+        """Breaker and limiter checks before one attempt. Returns True if the attempt is the breaker's probe."""
+        probe = False
+        try:
+            probe = self.breaker.before_call()
+            budget = self._limiter_budget(started, deadline)
+            waited = self.limiter.acquire("gemini_requests", 1, GEMINI_RPM, budget)
+            waited += self.limiter.acquire("gemini_tokens", estimated, GEMINI_TPM, budget - waited)
+        except BaseException as e:
+            self._refuse(e, probe)
+            raise
+        self._record_wait(waited)
+        return probe
+
+    def _refuse(self, error, probe):
+        """An attempt that never reached Gemini: hands back the breaker's probe if it had it."""
+        self._release(probe)
+        if isinstance(error, UpstreamUnavailable):
+            self._count(rejected=1)
+
+    def _release(self, probe):
+        if probe:
+            self.breaker.release_probe()
+
+    def _record_wait(self, waited):
+        with self.stats_lock:
+            self.totals["limiter_wait_s"] += waited
+            self.totals["limiter_max_wait_s"] = max(self.totals["limiter_max_wait_s"], waited)
+
+    def _backoff_or_raise(self, error, attempt, started, deadline):
+        """Called while handling a failed call: the seconds to wait before retrying, or raises."""
+        if not isinstance(error, RETRYABLE_GEMINI_ERRORS):
+            # Bad requests, safety blocks etc. are not the upstream being unhealthy
+            self.breaker.record_success()
+            raise error
+
+        self.breaker.record_failure()
+        backoff = random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * 2 ** attempt))
+        elapsed = time.monotonic() - started
+        if attempt >= GEMINI_MAX_RETRIES or elapsed + backoff >= deadline or self.breaker.state != "closed":
+            self._count(failures=1)
+            raise UpstreamUnavailable(
+                f"The AI service is busy or unavailable ({type(error).__name__}). Please try again shortly.",
+                retry_after=GEMINI_RETRY_MAX_SECONDS,
+            ) from error
+        print(f"Gemini {self.name} call failed ({type(error).__name__}), retry {attempt + 1} in {backoff:.2f}s")
+        self._count(retries=1)
+        return backoff
+
+    def _accept(self, response, estimated):
+        """Success bookkeeping for a finished call, including the limiter's token correction."""
+        self.breaker.record_success()
+        usage = getattr(response, "usage_metadata", None)
+        total = getattr(usage, "total_token_count", None)
+        if total:
+            self.limiter.adjust("gemini_tokens", total - estimated, GEMINI_TPM)
+
+    def _stream_failed(self, error, probe):
+        """A stream that broke off: counted like a failed call, unless the reader just stopped reading."""
+        if not isinstance(error, Exception):
+            # GeneratorExit: no verdict on the upstream
+            self._release(probe)
+            return
+        if isinstance(error, RETRYABLE_GEMINI_ERRORS):
+            self.breaker.record_failure()
+            self._count(failures=1)
+        else:
+            self.breaker.record_success()
+
+    @classmethod
+    def stats(cls, breaker):
+        with cls.stats_lock:
+            stats = dict(cls.totals)
+        stats["limiter_wait_s"] = round(stats["limiter_wait_s"], 3)
+        stats["limiter_max_wait_s"] = round(stats["limiter_max_wait_s"], 3)
+        stats["breaker_state"] = breaker.state
+        stats["breaker_consecutive_failures"] = breaker.consecutive_failures
+        stats["breaker_times_opened"] = breaker.times_opened
+        return stats
+
+
+class GeminiStream:
+    """A streamed response that reports to its GeminiClient once it has been read.
+
+    The breaker verdict and the usage (and with it the limiter's token
+    correction) are only known at the end of the stream, not when it opens.
+    """
+
+    def __init__(self, client, response, estimated, probe):
+        self.client = client
+        self.response = response
+        self.estimated = estimated
+        self.probe = probe
+
+    def __iter__(self):
+        try:
+            yield from self.response
+        except BaseException as e:
+            self.client._stream_failed(e, self.probe)
+            raise
+        self.client._accept(self.response, self.estimated)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+gemini_limiter = SharedTokenBucket(RATE_LIMIT_PATH)
+gemini_breaker = CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN_SECONDS)
+# Both models share one API key, so they share one quota and one breaker
+model = GeminiClient("recipes", recipe_gemini_model, gemini_limiter, gemini_breaker)
+chat_model = GeminiClient("chat", chat_gemini_model, gemini_limiter, gemini_breaker)
+
 # -----------------------------------------------------
 # --- HELPER FUNCTIONS (NEW/UPDATED) ---
 # -----------------------------------------------------
 
+class LRUCache:
+    """A small thread-safe LRU dict with hit/miss counters. Entries older than ttl_seconds (if set) miss."""
+
+    def __init__(self, max_entries, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (value, stored_at)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, stored_at = self.entries.get(key, (None, None))
+            if value is not None and self.ttl_seconds is not None and time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                value = None
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
 def get_user_settings():
     """Retrieves user settings (like mode and language) from session or defaults."""
     # Note: These values should correspond to what is set via the UI/settings page
@@ -189,21 +998,49 @@ def get_user_settings():
         'language': session.get('language', 'English')
     }
 
-def format_scans_for_template(scans_dict):
-    """Converts the internal USERS[username]['scans'] dictionary to a list suitable for the template."""
-    scan_list_summary = []
+def format_scans_for_template(scans):
+    """Converts stored scans (newest first) to a list of summaries suitable for the template."""
     # Prepare a list of summary data for the dashboard
-    for scan_id, data in scans_dict.items():
-        scan_list_summary.append({
-            "id": scan_id,
+    return [
+        {
+            "id": data["id"],
+            "timestamp": data["timestamp"],
             "date": data["date"],
             "title": data["summary_title"],
             "notes": data["summary_notes"],
             "image_url": data["summary_image"]
-        })
-    # Sort by timestamp (newest first)
-    scan_list_summary.sort(key=lambda x: scans_dict[x['id']]["timestamp"], reverse=True)
-    return scan_list_summary
+        }
+        for data in scans
+    ]
+
+
+def scan_cursor(scan):
+    """The ?before= value for the page after `scan`: its timestamp and id."""
+    return f"{scan['timestamp']!r}:{scan['id']}"
+
+
+def parse_scan_cursor(value):
+    """(timestamp, id) from a scan_cursor() value, or None. A bare timestamp (older links) means every
+    scan before it."""
+    if not value:
+        return None
+    timestamp, _, scan_id = value.partition(":")
+    try:
+        return float(timestamp), scan_id
+    except ValueError:
+        return None
+
+
+def get_history_page(username):
+    """Reads ?before=&limit= and returns (scan summaries, cursor for the next page or None)."""
+    before = parse_scan_cursor(request.args.get('before'))
+    limit = request.args.get('limit', default=SCAN_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, SCAN_PAGE_MAX))
+
+    # Ask for one extra row to learn whether there is a next page
+    scans = format_scans_for_template(store.list_scans(username, before=before, limit=limit + 1))
+    next_before = scan_cursor(scans[limit - 1]) if len(scans) > limit else None
+    return scans[:limit], next_before
 
 
 def get_user_context(username=None):
@@ -222,12 +1059,13 @@ def get_user_context(username=None):
     if username is None and is_logged_in:
         username = current_username
         
-    if username and username in USERS and is_logged_in:
+    stored_user = store.get_user(username) if username and is_logged_in else None
+    if stored_user:
         # Logged-in context
         user_data = {
             'is_logged_in': True,
             'username': username,
-            'id': USERS[username]['id']
+            'id': stored_user['id']
         }
     else:
         # Non-logged-in context (used for the login page and on login failure)
@@ -239,12 +1077,143 @@ def get_user_context(username=None):
         
     return user_data, settings
 
+# --- Image Lookup Cache ---
+def normalize_image_query(query):
+    """Normalizes a search query so trivially different spellings share a cache entry."""
+    normalized = " ".join((query or "").lower().split())
+    normalized = re.sub(r"\s*food dish$", "", normalized)
+    return normalized
+
+
+class ImageCache:
+    """Persistent LRU + TTL cache of Pexels query -> image URL.
+
+    Misses that returned "No Image Found" are cached too (with a shorter TTL),
+    so we don't keep asking Pexels for dishes it has no photo of. Eviction
+    runs every `evict_every` writes, so the table may briefly hold that many
+    rows (per worker) over max_entries. A database error only makes the
+    lookup uncached: get() misses and set() does nothing.
+    """
+
+    evict_every = 100
+
+    def __init__(self, path, max_entries, ttl_seconds, negative_ttl_seconds):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS image_cache (
+                query TEXT PRIMARY KEY,
+                image_url TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS image_cache_last_used ON image_cache (last_used);
+        """)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_sqlite(self.path)
+        return conn
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _failed(self, error):
+        print(f"Image cache error: {error}")
+        with self._stats_lock:
+            self.errors += 1
+
+    def get(self, query):
+        key = normalize_image_query(query)
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT image_url, expires_at FROM image_cache WHERE query = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] >= now:
+                conn.execute("UPDATE image_cache SET last_used = ? WHERE query = ?", (now, key))
+        except sqlite3.Error as e:
+            self._failed(e)
+            row = None
+        if row is None or row[1] < now:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return row[0]
+
+    def set(self, query, image_url):
+        key = normalize_image_query(query)
+        now = time.time()
+        ttl = self.negative_ttl_seconds if image_url == NO_IMAGE_FOUND_URL else self.ttl_seconds
+        with self._stats_lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO image_cache (query, image_url, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, image_url, now + ttl, now),
+            )
+            if evict:
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def _evict(self, conn, now):
+        # Expired rows first, then the least recently used ones over the size bound
+        conn.execute("DELETE FROM image_cache WHERE expires_at < ?", (now,))
+        conn.execute(
+            """DELETE FROM image_cache WHERE query IN (
+                   SELECT query FROM image_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+               )""",
+            (self.max_entries,),
+        )
+
+    def stats(self):
+        size = self._connection().execute("SELECT COUNT(*) FROM image_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "errors": self.errors,
+            "entries": size,
+            "max_entries": self.max_entries,
+        }
+
+
+image_cache = ImageCache(
+    IMAGE_CACHE_PATH,
+    max_entries=IMAGE_CACHE_MAX_ENTRIES,
+    ttl_seconds=IMAGE_CACHE_TTL_SECONDS,
+    negative_ttl_seconds=IMAGE_CACHE_NEGATIVE_TTL_SECONDS,
+)
+
 # --- Helper Function for Image Search ---
 def get_recipe_image(query):
     """Searches Pexels for an image matching the query."""
     if not PEXELS_API_KEY:
         return "https://placehold.co/600x400?text=No+API+Key"
 
+    cached_url = image_cache.get(query)
+    if cached_url:
+        return cached_url
+
     headers = {
         "Authorization": PEXELS_API_KEY
     }
@@ -256,44 +1225,996 @@ def get_recipe_image(query):
     }
     
     try:
-        response = requests.get(PEXELS_URL, headers=headers, params=params)
+        response = pexels_session.get(PEXELS_URL, headers=headers, params=params, timeout=PEXELS_TIMEOUT_SECONDS)
         response.raise_for_status()
         data = response.json()
         
         if 'photos' in data and len(data['photos']) > 0:
-            return data['photos'][0]['src']['medium']
+            image_url = data['photos'][0]['src']['medium']
         else:
-            return "https://placehold.co/600x400?text=No+Image+Found"
+            image_url = NO_IMAGE_FOUND_URL
+        # Errors are not cached, only real answers from Pexels
+        image_cache.set(query, image_url)
+        return image_url
             
     except Exception as e:
         print(f"Error fetching image: {e}")
         return "https://placehold.co/600x400?text=Error"
 
 
+def fetch_recipe_images(recipes):
+    """Fills in image_url for every recipe, running the Pexels lookups concurrently.
+
+    Lookups still unfinished at the stage deadline get a placeholder so slow
+    responses can't hold up the whole reply; those that never started are
+    cancelled, and those already running finish into the image cache.
+    """
+    started = time.perf_counter()
+    futures = [
+        image_lookup_pool.submit(get_recipe_image, f"{recipe['title']} food dish")
+        for recipe in recipes
+    ]
+    wait(futures, timeout=PEXELS_TIMEOUT_SECONDS)
+
+    for recipe, future in zip(recipes, futures):
+        if future.done() and not future.cancelled():
+            recipe['image_url'] = future.result()
+        else:
+            future.cancel()
+            recipe['image_url'] = "https://placehold.co/600x400?text=Timeout"
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"Image stage: {len(recipes)} lookups in {elapsed_ms:.0f} ms")
+    return elapsed_ms
+
+
+# -----------------------------------------------------
+# --- IMAGE PREPROCESSING ---
+# -----------------------------------------------------
+
+class ImageTooLarge(ValueError):
+    """Raised for uploads whose pixel count is over IMAGE_MAX_PIXELS."""
+
+
+normalization_totals = {"images": 0, "bytes_in": 0, "bytes_out": 0, "pixels_in": 0, "pixels_out": 0}
+normalization_lock = threading.Lock()
+
+
+def normalize_image(data):
+    """Decodes an uploaded photo and prepares it for Gemini.
+
+    Returns (image, blob, stats): the normalized RGB image, an inline
+    {"mime_type", "data"} part for generate_content, and the before/after
+    byte and pixel counts.
+    """
+    started = time.perf_counter()
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from e
+
+    width, height = image.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise ImageTooLarge(f"{width}x{height} exceeds the {IMAGE_MAX_PIXELS} pixel limit")
+
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale directly, which keeps memory down
+    image.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+    encoded = buffer.getvalue()
+
+    stats = {
+        "bytes_in": len(data),
+        "bytes_out": len(encoded),
+        "pixels_in": width * height,
+        "pixels_out": image.width * image.height,
+    }
+    with normalization_lock:
+        normalization_totals["images"] += 1
+        for key, value in stats.items():
+            normalization_totals[key] += value
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(
+        f"Image normalized: {stats['bytes_in']} -> {stats['bytes_out']} bytes, "
+        f"{stats['pixels_in']} -> {stats['pixels_out']} px in {elapsed_ms:.0f} ms"
+    )
+    blob = {"mime_type": f"image/{IMAGE_FORMAT.lower()}", "data": encoded}
+    return image, blob, stats
+
+
+# -----------------------------------------------------
+# --- RECIPE GENERATION ---
+# -----------------------------------------------------
+
+class MalformedModelOutput(Exception):
+    """Raised when Gemini's answer can't be parsed as a recipe list."""
+
+
+def fingerprint_image(image):
+    """Returns (exact_hash, perceptual_hash) for a decoded image.
+
+    The exact hash covers the decoded pixels, so re-uploads of the same photo
+    match even if the file bytes differ. The perceptual hash is a 64-bit dHash
+    that also matches re-encoded or slightly resized copies.
+    """
+    exact = hashlib.sha256()
+    exact.update(f"{image.mode}:{image.size}".encode())
+    exact.update(image.tobytes())
+
+    small = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()  # One byte per pixel in "L" mode
+    perceptual = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            perceptual = (perceptual << 1) | (left > right)
+    return exact.hexdigest(), perceptual
+
+
+class AnalysisCache:
+    """Bounded in-memory LRU cache of /analyze results.
+
+    Identical concurrent requests are coalesced: the first one runs the
+    generation, the others wait for its result instead of calling Gemini again.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, max_distance):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()  # (exact_hash, language, units) -> (perceptual_hash, recipes, stored_at)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, exact_hash, perceptual_hash, language, units):
+        now = time.time()
+        key = (exact_hash, language, units)
+        entry = self._entries.get(key)
+        if entry is None:
+            # Fall back to the closest perceptual match with the same settings
+            for other_key, other in self._entries.items():
+                if other_key[1:] != (language, units):
+                    continue
+                if bin(other[0] ^ perceptual_hash).count("1") <= self.max_distance:
+                    key, entry = other_key, other
+                    break
+        if entry is None:
+            return None
+        if now - entry[2] > self.ttl_seconds:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, exact_hash, perceptual_hash, language, units, recipes):
+        self._entries[(exact_hash, language, units)] = (perceptual_hash, copy.deepcopy(recipes), time.time())
+        self._entries.move_to_end((exact_hash, language, units))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_or_compute(self, exact_hash, perceptual_hash, language, units, compute):
+        """Returns (recipes, cached). `compute` runs only on a miss with no identical call in flight."""
+        key = (exact_hash, language, units)
+        with self._lock:
+            recipes = self._lookup(exact_hash, perceptual_hash, language, units)
+            if recipes is not None:
+                self.hits += 1
+                return copy.deepcopy(recipes), True
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            return copy.deepcopy(future.result()), True
+
+        try:
+            recipes = compute()
+        except BaseException as e:
+            # Even on KeyboardInterrupt or SystemExit, or the waiters would block forever
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        # Store before leaving the in-flight table so no request can miss both
+        with self._lock:
+            self._store(exact_hash, perceptual_hash, language, units, recipes)
+            self._in_flight.pop(key, None)
+        future.set_result(recipes)
+        return copy.deepcopy(recipes), False
+
+    def lookup(self, exact_hash, perceptual_hash, language, units):
+        """Returns cached recipes or None, without coalescing (used by the streaming path)."""
+        with self._lock:
+            recipes = self._lookup(exact_hash, perceptual_hash, language, units)
+            if recipes is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy.deepcopy(recipes)
+
+    def store(self, exact_hash, perceptual_hash, language, units, recipes):
+        with self._lock:
+            self._store(exact_hash, perceptual_hash, language, units, recipes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "max_entries": self.max_entries,
+            }
+
+
+analysis_cache = AnalysisCache(
+    ANALYSIS_CACHE_MAX_ENTRIES,
+    ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS,
+    max_distance=ANALYSIS_CACHE_PHASH_DISTANCE,
+)
+
+
+def build_recipe_prompt(language, units):
+    """Builds the /analyze prompt for the user's language and unit settings."""
+    prompt_language = "Български" if language == "Bulgarian" else "English"
+
+    return f"""
+    Analyze this image and identify the ingredients.
+    Based on these ingredients, suggest 2 distinct recipes.
+    
+    **CRITICAL INSTRUCTION: Generate the entire output (Title, Description, Ingredients, and Instructions) entirely in {prompt_language}.**
+    
+    SETTINGS:
+    - Units: Use the {units} system for all measurements (e.g. if Metric use grams/Celsius, if Imperial use cups/pounds/Fahrenheit).
+    
+    Return the response in the specific JSON format defined in your system instructions.
+    """
+
+
+def relax_json(text):
+    """Strips // comments and trailing commas outside of strings, the two slips models make most."""
+    out = []
+    in_string = escaped = False
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch == '/' and text.startswith('//', i):
+            newline = text.find('\n', i)
+            i = len(text) if newline == -1 else newline
+            continue
+        elif ch in '}]':
+            # Drop a comma that directly precedes the closing bracket
+            j = len(out) - 1
+            while j >= 0 and out[j].isspace():
+                j -= 1
+            if j >= 0 and out[j] == ',':
+                del out[j]
+            out.append(ch)
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def loads_relaxed(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(relax_json(text))
+
+
+def coerce_text_list(value):
+    if not isinstance(value, list):
+        return []
+    return [str(item).strip() for item in value if isinstance(item, (str, int, float)) and str(item).strip()]
+
+
+def validate_recipe(recipe):
+    """Returns a cleaned copy of a recipe, or None if it can't be shown or saved."""
+    if not isinstance(recipe, dict):
+        return None
+    title = recipe.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return None
+    ingredients = coerce_text_list(recipe.get('ingredients'))
+    instructions = coerce_text_list(recipe.get('instructions'))
+    if not ingredients or not instructions:
+        return None
+
+    time_minutes = recipe.get('time_minutes')
+    if isinstance(time_minutes, str):
+        digits = re.search(r"\d+", time_minutes)
+        time_minutes = int(digits.group()) if digits else None
+    if isinstance(time_minutes, float):
+        time_minutes = round(time_minutes)
+    if not isinstance(time_minutes, int) or isinstance(time_minutes, bool) or time_minutes < 0:
+        time_minutes = 0
+
+    skill_level = str(recipe.get('skill_level') or '').strip().capitalize()
+    if skill_level not in SKILL_LEVELS:
+        skill_level = "Medium"
+
+    cleaned = {
+        "title": title.strip(),
+        "description": str(recipe.get('description') or '').strip(),
+        "ingredients": ingredients,
+        "instructions": instructions,
+        "time_minutes": time_minutes,
+        "skill_level": skill_level,
+    }
+    if 'image_url' in recipe:
+        cleaned['image_url'] = recipe['image_url']
+    return cleaned
+
+
+recipe_parse_stats = {"parses": 0, "clean": 0, "repaired": 0, "failed": 0, "recipes_dropped": 0}
+recipe_parse_lock = threading.Lock()
+
+
+def record_parse_outcome(outcome, dropped=0):
+    """Counts one parse as 'clean', 'repaired' or 'failed' (a failure means a regeneration)."""
+    with recipe_parse_lock:
+        recipe_parse_stats["parses"] += 1
+        recipe_parse_stats[outcome] += 1
+        recipe_parse_stats["recipes_dropped"] += dropped
+
+
+def recipe_parse_summary():
+    with recipe_parse_lock:
+        summary = dict(recipe_parse_stats)
+    parses = summary["parses"]
+    summary["failure_rate"] = round(summary["failed"] / parses, 4) if parses else 0.0
+    summary["repair_rate"] = round(summary["repaired"] / parses, 4) if parses else 0.0
+    return summary
+
+
+def parse_recipes(text):
+    """Parses model output into validated recipes.
+
+    Output that isn't valid JSON (truncated arrays, comments, trailing commas)
+    is salvaged object by object, keeping every recipe that is complete.
+    Raises MalformedModelOutput only when nothing usable is left.
+    """
+    cleaned = (text or '').strip()
+    if cleaned.startswith("```"):
+        cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", cleaned)
+
+    try:
+        data = json.loads(cleaned)
+        outcome = "clean"
+        if isinstance(data, dict):
+            data = data.get('recipes', [data])
+        if not isinstance(data, list):
+            data = []
+    except json.JSONDecodeError as json_e:
+        print(f"Repairing malformed model output: {json_e}")
+        data = RecipeStreamParser().feed(cleaned)
+        outcome = "repaired"
+
+    recipes = [recipe for recipe in map(validate_recipe, data) if recipe]
+    dropped = len(data) - len(recipes)
+    if not recipes:
+        record_parse_outcome("failed", dropped)
+        # Print the faulty JSON to the Flask console for debugging
+        print("\n--- JSON PARSE ERROR ---")
+        print("Raw Model Output:")
+        print(text)
+        print("------------------------\n")
+        raise MalformedModelOutput("no complete recipe in the response")
+
+    record_parse_outcome("repaired" if dropped else outcome, dropped)
+    return recipes
+
+
+def generate_recipes(image_blob, language, units):
+    """Asks Gemini for recipes for the image and fills in their images."""
+    # 1. Build the dynamic prompt including the settings
+    prompt = build_recipe_prompt(language, units)
+    
+    # 2. Ask Gemini for recipes (THE ACTUAL API CALL), constrained to the recipe schema
+    response = model.generate_content(
+        [prompt, image_blob],
+        generation_config={"response_schema": RECIPE_LIST_SCHEMA},
+    )
+    
+    # Robust parsing: salvages what it can instead of failing the whole scan
+    recipes = parse_recipes(response.text)
+
+    # 3. Fetch images for all recipes in parallel
+    fetch_recipe_images(recipes)
+    return recipes
+
+
+class RecipeStreamParser:
+    """Pulls complete recipe objects out of a JSON array as it is streamed.
+
+    feed() takes the next chunk of model output and returns the top-level
+    objects that were completed by it. The object still being written is
+    available through partial_title() as soon as its title has arrived.
+    """
+
+    # The recipe format puts "title" first, so it can be read before the object is complete
+    TITLE_RE = re.compile(r'^\{\s*"title"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self):
+        self._current = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        completed = []
+        for ch in text:
+            if self._depth == 0:
+                # Between objects: skip '[', ',', ']' and whitespace
+                if ch == '{':
+                    self._current = [ch]
+                    self._depth = 1
+                continue
+
+            self._current.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        completed.append(loads_relaxed("".join(self._current)))
+                    except json.JSONDecodeError as e:
+                        print(f"Skipping malformed recipe object in stream: {e}")
+                    self._current = []
+        return completed
+
+    def partial_title(self):
+        """Returns the title of the object being written, once it is complete."""
+        if not self._current:
+            return None
+        match = self.TITLE_RE.match("".join(self._current))
+        if not match:
+            return None
+        return json.loads(f'"{match.group(1)}"')
+
+
+def ndjson_line(payload):
+    return json.dumps(payload, ensure_ascii=False) + "\n"
+
+
+def stream_analysis(image_blob, exact_hash, perceptual_hash, language, units):
+    """Yields NDJSON events for a streamed /analyze.
+
+    Each recipe is sent as soon as its object is complete. Its image lookup
+    starts as soon as its title has been parsed; images that are not ready
+    with the recipe follow as separate `image` events. The scan is saved
+    once at the end.
+    """
+    started = time.perf_counter()
+
+    recipes = analysis_cache.lookup(exact_hash, perceptual_hash, language, units)
+    cached = recipes is not None
+    if cached:
+        for index, recipe in enumerate(recipes):
+            yield ndjson_line({"type": "recipe", "index": index, "recipe": recipe})
+    else:
+        recipes = []
+        image_futures = []
+        pending_images = {}  # partial title -> lookup started before its object was complete
+        parser = RecipeStreamParser()
+        streamed_text = []
+        dropped = 0
+
+        def start_image_lookup(title):
+            return image_lookup_pool.submit(get_recipe_image, f"{title} food dish")
+
+        def ready_images():
+            # Images that finished since the last check, for recipes already sent
+            for index, future in enumerate(image_futures):
+                if future is not None and future.done():
+                    recipes[index]['image_url'] = future.result()
+                    image_futures[index] = None
+                    yield ndjson_line({"type": "image", "index": index, "image_url": recipes[index]['image_url']})
+
+        try:
+            response = model.generate_content(
+                [build_recipe_prompt(language, units), image_blob],
+                stream=True,
+                generation_config={"response_schema": RECIPE_LIST_SCHEMA},
+            )
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue
+                streamed_text.append(text)
+
+                for parsed in parser.feed(text):
+                    # Every object must pass validation before it is shown or saved
+                    recipe = validate_recipe(parsed)
+                    if recipe is None:
+                        dropped += 1
+                        continue
+                    # By title: an object the parser dropped must not hand its image to the next one
+                    future = pending_images.pop(recipe['title'], None) or start_image_lookup(recipe['title'])
+                    recipe['image_url'] = future.result() if future.done() else None
+                    recipes.append(recipe)
+                    image_futures.append(None if future.done() else future)
+                    yield ndjson_line({"type": "recipe", "index": len(recipes) - 1, "recipe": recipe})
+
+                title = parser.partial_title()
+                if title and title not in pending_images:
+                    pending_images[title] = start_image_lookup(title)
+
+                yield from ready_images()
+
+        except UpstreamUnavailable as e:
+            yield ndjson_line({"type": "error", "error": str(e), "retry_after": math.ceil(e.retry_after)})
+            return
+
+        except Exception as e:
+            print(f"Analyze stream error: {e}")
+            yield ndjson_line({"type": "error", "error": f"An internal error occurred: {str(e)}."})
+            return
+
+        if not recipes:
+            record_parse_outcome("failed", dropped)
+            yield ndjson_line({
+                "type": "error",
+                "error": "The AI generated malformed output. Please try again with a clearer image or different settings.",
+            })
+            return
+
+        try:
+            json.loads("".join(streamed_text))
+            outcome = "repaired" if dropped else "clean"
+        except json.JSONDecodeError:
+            outcome = "repaired"
+        record_parse_outcome(outcome, dropped)
+
+        # Wait for the remaining lookups, all of them together bounded by one deadline
+        deadline = time.monotonic() + PEXELS_TIMEOUT_SECONDS
+        for index, future in enumerate(image_futures):
+            if future is None:
+                continue
+            try:
+                recipes[index]['image_url'] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception:
+                future.cancel()
+                recipes[index]['image_url'] = "https://placehold.co/600x400?text=Timeout"
+            yield ndjson_line({"type": "image", "index": index, "image_url": recipes[index]['image_url']})
+
+        analysis_cache.store(exact_hash, perceptual_hash, language, units, recipes)
+
+    new_scan_id = None
+    if session.get("logged_in"):
+        new_scan_id = save_new_scan(recipes)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"Analyze stream: {len(recipes)} recipes in {elapsed_ms:.0f} ms (cached={cached})")
+    yield ndjson_line({"type": "done", "scan_id": new_scan_id, "cached": cached})
+
 # -----------------------------------------------------
 # --- SCAN DATA HANDLER ---
 # -----------------------------------------------------
 
-def save_new_scan(recipes):
-    """Saves the recipe data to the current user's scan history."""
-    username = session.get('username')
-    if not username or username not in USERS:
+def save_new_scan(recipes, username=None):
+    """Saves the recipe data to the user's scan history (the current user by default)."""
+    username = username or session.get('username')
+    if not username or not store.get_user(username):
         return None # Cannot save scan if user is not logged in
 
+    # Never persist a recipe the pages can't render
+    recipes = [recipe for recipe in map(validate_recipe, recipes) if recipe]
+    if not recipes:
+        return None
+
     scan_id = str(uuid.uuid4()) # Generate a unique ID
     
     # Store the entire recipe list generated by Gemini
-    USERS[username]["scans"][scan_id] = {
+    store.add_scan(username, scan_id, {
         "date": datetime.now().strftime("%b %d, %Y"),
         "timestamp": datetime.now().timestamp(),
         "recipes": recipes,
         "summary_title": recipes[0]['title'], # Use the first recipe for the dashboard summary
         "summary_notes": recipes[0]['description'],
         "summary_image": recipes[0]['image_url']
-    }
+    })
     return scan_id
 
 
+# -----------------------------------------------------
+# --- ANALYSIS JOBS ---
+# -----------------------------------------------------
+
+class AnalysisJobQueue:
+    """Runs /analyze work on a bounded pool of background threads.
+
+    At most `workers` jobs run at once and at most `queue_limit` more wait;
+    submit() returns False instead of queueing beyond that, so a burst of
+    scans gets a fast 503 rather than tying up every gunicorn worker.
+
+    Job rows outlive the worker that took them. While a job is queued or
+    running here, a heartbeat thread keeps its heartbeat_at fresh; each beat
+    also fails other workers' jobs that stopped getting one (their worker was
+    recycled or crashed), so pollers get an error instead of waiting forever.
+    """
+
+    def __init__(self, workers, queue_limit):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-job")
+        self._lock = threading.Lock()
+        self._queued = {}  # job_id -> enqueued_at
+        self._running = set()
+        self._heartbeat = None
+        self.orphaned = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._total_wait = 0.0
+
+    def submit(self, job_id, fn):
+        with self._lock:
+            if len(self._queued) + len(self._running) >= self.workers + self.queue_limit:
+                self.rejected += 1
+                return False
+            self._queued[job_id] = time.time()
+            if self._heartbeat is None:
+                # Started on first use, so a preloading gunicorn master never owns one
+                self._heartbeat = threading.Thread(target=self._beat, name="analysis-job-heartbeat", daemon=True)
+                self._heartbeat.start()
+        self._pool.submit(self._run, job_id, fn)
+        return True
+
+    def _beat(self):
+        while True:
+            with self._lock:
+                live = [*self._queued, *self._running]
+            try:
+                store.touch_jobs(live)
+                self.orphaned += fail_orphaned_jobs()
+            except Exception as e:
+                print(f"Analysis job heartbeat failed: {e}")
+            time.sleep(ANALYSIS_JOB_HEARTBEAT_SECONDS)
+
+    def _run(self, job_id, fn):
+        with self._lock:
+            self._total_wait += time.time() - self._queued.pop(job_id)
+            self._running.add(job_id)
+        try:
+            fn()
+            succeeded = True
+        except Exception:
+            succeeded = False
+        with self._lock:
+            self._running.discard(job_id)
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            started = self.completed + self.failed + len(self._running)
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "queue_depth": len(self._queued),
+                "running": len(self._running),
+                "oldest_queued_age_s": round(now - min(self._queued.values()), 3) if self._queued else 0.0,
+                "avg_wait_ms": round(self._total_wait / started * 1000, 1) if started else 0.0,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "orphaned": self.orphaned,
+            }
+
+
+ORPHANED_JOB_ERROR = "The server restarted before this scan finished. Please try again."
+
+
+def fail_orphaned_jobs(job_id=None):
+    """Fails queued or running jobs (all, or just `job_id`) that missed their heartbeats."""
+    return store.fail_orphaned_jobs(time.time() - ANALYSIS_JOB_ORPHANED_AFTER_SECONDS, ORPHANED_JOB_ERROR, job_id)
+
+
+analysis_jobs = AnalysisJobQueue(ANALYSIS_JOB_WORKERS, ANALYSIS_JOB_QUEUE_LIMIT)
+
+
+def run_analysis_job(job_id, image_blob, exact_hash, perceptual_hash, language, units, username):
+    """Background body of an /analyze job; records the outcome on the job row."""
+    store.update_job(job_id, status="running", started_at=time.time())
+    try:
+        recipes, cached = analysis_cache.get_or_compute(
+            exact_hash, perceptual_hash, language, units,
+            lambda: generate_recipes(image_blob, language, units),
+        )
+        new_scan_id = None
+        if username and recipes and isinstance(recipes, list):
+            new_scan_id = save_new_scan(recipes, username=username)
+        store.update_job(
+            job_id, status="done", finished_at=time.time(),
+            result={"recipes": recipes, "scan_id": new_scan_id, "cached": cached},
+        )
+    except MalformedModelOutput as e:
+        store.update_job(
+            job_id, status="error", finished_at=time.time(),
+            error=f'The AI generated malformed output. Please try again with a clearer image or different settings. Details: {e}',
+        )
+        raise
+    except UpstreamUnavailable as e:
+        store.update_job(job_id, status="error", finished_at=time.time(), error=str(e))
+        raise
+    except Exception as e:
+        print(f"Analysis job {job_id} failed: {e}")
+        store.update_job(job_id, status="error", finished_at=time.time(), error=f'An internal error occurred: {str(e)}.')
+        raise
+
+
+def job_view(job):
+    """Public fields of a job for the status endpoint."""
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "result": job["result"],
+        "error": job["error"],
+    }
+
+
+# -----------------------------------------------------
+# --- CHAT SESSIONS ---
+# -----------------------------------------------------
+# A conversation keeps its turns on the server, so the browser only sends the
+# new message plus a conversation_id. The scan context and any photo are
+# attached once per conversation: the photo is uploaded through the File API
+# and referenced by URI afterwards, and when the context is big enough it is
+# put in a Gemini context cache instead of being re-sent every turn. Once the
+# history grows past CHAT_TOKEN_BUDGET the oldest turns are folded into a
+# rolling summary.
+
+chat_totals = {
+    "turns": 0, "prompt_tokens_est": 0, "compactions": 0, "compaction_failures": 0, "turns_dropped": 0,
+    "files_uploaded": 0, "upload_failures": 0, "cache_created": 0, "cache_hits": 0, "cache_failures": 0,
+}
+chat_stats_lock = threading.Lock()
+# Context cache name -> GeminiClient, per process (looking a cache up is a network call).
+# Kept no longer than the caches themselves live.
+cached_chat_clients = LRUCache(CHAT_CLIENT_CACHE_ENTRIES, ttl_seconds=CHAT_CONTEXT_CACHE_TTL_SECONDS)
+
+
+def count_chat(**increments):
+    with chat_stats_lock:
+        for key, value in increments.items():
+            chat_totals[key] += value
+
+
+def scan_context_text(scan):
+    """Compact but useful JSON context for a past scan."""
+    recipes = scan.get('recipes', [])
+    scan_context = {
+        "scan_date": scan.get('date'),
+        "recipes": [
+            {
+                "title": r.get('title'),
+                "description": r.get('description'),
+                "ingredients": r.get('ingredients', [])[:30],
+                "instructions": r.get('instructions', [])[:12],
+            }
+            for r in recipes[:2]
+        ],
+    }
+    return "Past scan context (JSON): " + json.dumps(scan_context, ensure_ascii=False)
+
+
+def load_conversation(conversation_id, username, scan_id):
+    """Returns the caller's conversation, or a new one if it's missing, foreign or about another scan."""
+    conversation = store.get_conversation(conversation_id) if conversation_id else None
+    if conversation and conversation["username"] == username and conversation["scan_id"] == scan_id:
+        return conversation
+
+    context_text = None
+    if scan_id and username:
+        scan = store.get_scan(username, scan_id)
+        if scan:
+            context_text = scan_context_text(scan)
+    now = time.time()
+    return {
+        "id": str(uuid.uuid4()),
+        "username": username,
+        "scan_id": scan_id,
+        "context_text": context_text,
+        "summary": "",
+        "turns": [],
+        "files": [],
+        "cache_name": None,
+        "cache_expires_at": 0,
+        "cache_failed": False,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def file_part(file):
+    return {"file_data": {"mime_type": file["mime_type"], "file_uri": file["uri"]}}
+
+
+def attach_conversation_image(conversation, image_blob):
+    """Uploads a photo once; returns the inline blob instead if the upload fails."""
+    try:
+        uploaded = genai.upload_file(io.BytesIO(image_blob["data"]), mime_type=image_blob["mime_type"])
+    except Exception as e:
+        print(f"Chat image upload failed, sending it inline: {e}")
+        count_chat(upload_failures=1)
+        return image_blob
+    count_chat(files_uploaded=1)
+    conversation["files"].append({"uri": uploaded.uri, "mime_type": image_blob["mime_type"], "uploaded_at": time.time()})
+    # The context cache doesn't cover the new photo
+    conversation["cache_name"] = None
+    conversation["cache_failed"] = False
+    return None
+
+
+def context_parts(conversation):
+    """The per-conversation context: scan JSON and uploaded photos that haven't expired."""
+    now = time.time()
+    conversation["files"] = [f for f in conversation["files"] if now - f["uploaded_at"] < GEMINI_FILE_TTL_SECONDS]
+    parts = [conversation["context_text"]] if conversation["context_text"] else []
+    return parts + [file_part(f) for f in conversation["files"]]
+
+
+def chat_client_for(conversation):
+    """Returns (client, context_is_cached) for this conversation.
+
+    Creates a context cache when the context reaches the model's minimum cache
+    size; any failure falls back to sending the context inline with the turn.
+    """
+    now = time.time()
+    parts = context_parts(conversation)
+    if conversation["cache_name"] and conversation["cache_expires_at"] > now + 60:
+        client = cached_chat_clients.get(conversation["cache_name"])
+        try:
+            if client is None:
+                cached_model = genai.GenerativeModel.from_cached_content(
+                    conversation["cache_name"],
+                    generation_config=chat_generation_config,
+                    safety_settings=safety_settings,
+                )
+                client = GeminiClient("chat", cached_model, gemini_limiter, gemini_breaker)
+                cached_chat_clients.put(conversation["cache_name"], client)
+            count_chat(cache_hits=1)
+            return client, True
+        except Exception as e:
+            print(f"Chat context cache lookup failed: {e}")
+            count_chat(cache_failures=1)
+            conversation["cache_name"] = None
+
+    if conversation["cache_failed"] or not parts:
+        return chat_model, False
+    if estimate_tokens([CHAT_SYSTEM_INSTRUCTION] + parts) < CHAT_CONTEXT_CACHE_MIN_TOKENS:
+        return chat_model, False
+
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=chat_gemini_model.model_name,
+            display_name=f"chat-{conversation['id']}",
+            system_instruction=CHAT_SYSTEM_INSTRUCTION,
+            contents=[{"role": "user", "parts": parts}],
+            ttl=timedelta(seconds=CHAT_CONTEXT_CACHE_TTL_SECONDS),
+        )
+        cached_model = genai.GenerativeModel.from_cached_content(
+            cache, generation_config=chat_generation_config, safety_settings=safety_settings
+        )
+    except Exception as e:
+        # e.g. a model or tier without caching; don't try again for this conversation
+        print(f"Chat context cache unavailable, sending context inline: {e}")
+        count_chat(cache_failures=1)
+        conversation["cache_failed"] = True
+        return chat_model, False
+
+    count_chat(cache_created=1)
+    client = GeminiClient("chat", cached_model, gemini_limiter, gemini_breaker)
+    cached_chat_clients.put(cache.name, client)
+    conversation["cache_name"] = cache.name
+    conversation["cache_expires_at"] = now + CHAT_CONTEXT_CACHE_TTL_SECONDS
+    return client, True
+
+
+def build_chat_contents(conversation, message, preferences, context_cached, inline_image=None):
+    """History turns plus the new user turn, which carries preferences, summary and (uncached) context."""
+    parts = [preferences]
+    if conversation["summary"]:
+        parts.append("Summary of the earlier conversation: " + conversation["summary"])
+    if not context_cached:
+        parts.extend(context_parts(conversation))
+    parts.append("User message: " + message)
+    if inline_image is not None:
+        parts.append(inline_image)
+
+    contents = [{"role": turn["role"], "parts": [turn["text"]]} for turn in conversation["turns"]]
+    contents.append({"role": "user", "parts": parts})
+    count_chat(turns=1, prompt_tokens_est=estimate_tokens(contents))
+    return contents
+
+
+def record_chat_turn(conversation, message, answer, sent_image):
+    """Appends the exchange and saves the conversation; returns the `done` payload."""
+    if sent_image:
+        message = (message + " [photo attached]").strip()
+    conversation["turns"].append({"role": "user", "text": message})
+    conversation["turns"].append({"role": "model", "text": answer})
+    store.save_conversation(conversation)
+    return {"conversation_id": conversation["id"]}
+
+
+def compact_conversation(conversation):
+    """Folds the oldest turns into the rolling summary once the history is over budget."""
+    turns = conversation["turns"]
+    keep = 2 * CHAT_KEEP_RECENT_TURNS
+    history_tokens = estimate_tokens([conversation["summary"]] + [turn["text"] for turn in turns])
+    if history_tokens <= CHAT_TOKEN_BUDGET or len(turns) <= keep:
+        return
+
+    old, recent = turns[:-keep], turns[-keep:]
+    transcript = "\n".join(f"{turn['role']}: {turn['text']}" for turn in old)
+    prompt = (
+        "Update the running summary of a cooking chat. Keep dishes, ingredients, quantities, "
+        "dietary constraints and decisions the user made; drop small talk. "
+        "Answer with the summary only, under 150 words, in the language of the conversation.\n\n"
+        f"Current summary: {conversation['summary'] or '(none)'}\n\nNew turns:\n{transcript}"
+    )
+    try:
+        response = chat_model.generate_content(prompt, deadline=GEMINI_DEADLINE_SECONDS / 2)
+        summary = (response.text or '').strip()
+        if not summary:
+            raise ValueError("empty summary")
+        conversation["summary"] = summary
+        count_chat(compactions=1)
+    except Exception as e:
+        # Still bound the history; the summary just doesn't cover these turns
+        print(f"Chat compaction failed, dropping {len(old)} turns: {e}")
+        count_chat(compaction_failures=1, turns_dropped=len(old))
+    conversation["turns"] = recent
+    store.save_conversation(conversation)
+
+
 # -----------------------------------------------------
 # --- AUTHENTICATION ROUTES (UPDATED) ---
 # -----------------------------------------------------
@@ -317,9 +2238,9 @@ def login_or_register():
                                active_tab='account')
 
     # Check if user already exists
-    if username in USERS:
+    user_data = store.get_user(username)
+    if user_data:
         # --- LOGIN ATTEMPT ---
-        user_data = USERS[username]
         
         # Check password against stored hash
         if check_password_hash(user_data['password_hash'], password):
@@ -345,13 +2266,16 @@ def login_or_register():
         # 1. Securely Hash the Password
         hashed_password = generate_password_hash(password)
         
-        # 2. Save New User Data
+        # 2. Save New User Data (False if another worker registered the name first)
         user_id = str(uuid.uuid4())
-        USERS[username] = {
-            'password_hash': hashed_password,
-            'id': user_id,
-            'scans': {} # Initialize empty scan history
-        }
+        if not store.create_user(username, user_id, hashed_password):
+            user, userSettings = get_user_context(None)
+            return render_template('account.html', 
+                                   user=user, 
+                                   userSettings=userSettings, 
+                                   scans=[],
+                                   error_message=True, # Pass the error flag
+                                   active_tab='account')
         
         # 3. Log the new user in immediately
         session['logged_in'] = True
@@ -392,15 +2316,19 @@ def account_page():
     translations = TRANSLATIONS.get(userSettings['language'], TRANSLATIONS['English'])
     
     scan_list_summary = []
+    next_before = None
+    scan_count = 0
     if user['is_logged_in']:
-        user_scans = USERS[user['username']]["scans"]
-        scan_list_summary = format_scans_for_template(user_scans)
+        scan_list_summary, next_before = get_history_page(user['username'])
+        scan_count = store.count_scans(user['username'])
     
     return render_template(
         'account.html', 
         active_tab='account', 
         user=user, 
         scans=scan_list_summary,
+        scan_count=scan_count,
+        next_before=next_before,
         userSettings=userSettings,
         t=translations 
     )
@@ -414,12 +2342,12 @@ def scan_details_page(scan_id):
     
     current_username = user.get("username")
     
-    if not user.get("is_logged_in") or current_username not in USERS:
+    if not user.get("is_logged_in"):
         flash('Please log in to view your scan history.', 'warning')
         return redirect(url_for('account_page'))
         
-    # Get scan from the specific user's scan dictionary
-    scan = USERS[current_username]["scans"].get(scan_id)
+    # Get scan from the specific user's scan history
+    scan = store.get_scan(current_username, scan_id)
     
     if not scan:
         # User requested an ID that doesn't exist
@@ -448,23 +2376,99 @@ def chat_page():
     translations = TRANSLATIONS.get(userSettings['language'], TRANSLATIONS['English'])
 
     scan_list_summary = []
+    next_before = None
     if user.get('is_logged_in'):
-        user_scans = USERS[user['username']]["scans"]
-        scan_list_summary = format_scans_for_template(user_scans)
+        scan_list_summary, next_before = get_history_page(user['username'])
 
     return render_template(
         'chat.html',
         active_tab='chat',
         user=user,
         scans=scan_list_summary,
+        next_before=next_before,
         userSettings=userSettings,
         t=translations,
     )
 
 
+@app.route('/api/scans')
+def scans_api():
+    """One page of the user's scan history as JSON, for infinite scroll."""
+    user, _ = get_user_context()
+    if not user.get('is_logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+
+    scans, next_before = get_history_page(user['username'])
+    for scan in scans:
+        scan['url'] = url_for('scan_details_page', scan_id=scan['id'])
+    return jsonify({'scans': scans, 'next_before': next_before})
+
+
+def upstream_unavailable_response(e):
+    """503 with Retry-After for calls refused by the Gemini limiter or breaker."""
+    response = jsonify({'error': str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response
+
+
+def sse_event(event, payload):
+    """Formats one Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def stream_chat_answer(contents, client=chat_model, on_answer=None):
+    """Yields the chat answer as SSE `token` events, then `done` or `error`.
+
+    on_answer(answer) is called with the full text before `done` and returns
+    extra fields for the `done` payload.
+    """
+    started = time.perf_counter()
+    first_token_ms = None
+    chunks = []
+    try:
+        response = client.generate_content(contents, stream=True)
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. the final finish_reason chunk)
+                continue
+            if not text:
+                continue
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - started) * 1000
+            chunks.append(text)
+            yield sse_event("token", {"text": text})
+
+        if first_token_ms is None:
+            yield sse_event("error", {"error": "No response from AI"})
+        else:
+            done = on_answer("".join(chunks).strip()) if on_answer else None
+            yield sse_event("done", done or {})
+
+    except UpstreamUnavailable as e:
+        yield sse_event("error", {"error": str(e), "retry_after": math.ceil(e.retry_after)})
+
+    except Exception as e:
+        print(f"Chat stream error: {e}")
+        yield sse_event("error", {"error": f"Chat failed: {str(e)}"})
+
+    finally:
+        total_ms = (time.perf_counter() - started) * 1000
+        first_token = f"{first_token_ms:.0f} ms" if first_token_ms is not None else "n/a"
+        print(f"Chat stream: first token {first_token}, total {total_ms:.0f} ms")
+
+
 @app.route('/chat_api', methods=['POST'])
 def chat_api():
-    """Chat endpoint. Accepts text, optional image, and optional scan_id."""
+    """Chat endpoint. Accepts text, optional image, optional scan_id and conversation_id.
+
+    The conversation is kept on the server (see CHAT SESSIONS); the reply
+    carries the conversation_id to send with the next message. Clients that
+    send `Accept: text/event-stream` (or stream=1) get the answer token by
+    token as Server-Sent Events instead of a single JSON reply.
+    """
     try:
         message = request.form.get('message', '').strip()
         scan_id = request.form.get('scan_id')
@@ -481,52 +2485,65 @@ def chat_api():
         if lang not in ('English', 'Bulgarian'):
             lang = 'English'
         units = session.get('units', 'Metric')
-
-        prompt_parts = []
-        prompt_parts.append(
+        preferences = (
             f"User preferences: language={lang}, units={units}. Respond in {('Bulgarian' if lang=='Bulgarian' else 'English')}."
         )
 
-        # If a scan is selected and user is logged in, attach scan context
-        if scan_id and user.get('is_logged_in'):
-            username = user.get('username')
-            scan = USERS.get(username, {}).get('scans', {}).get(scan_id)
-            if scan:
-                # Compact but useful context
-                recipes = scan.get('recipes', [])
-                scan_context = {
-                    "scan_date": scan.get('date'),
-                    "recipes": [
-                        {
-                            "title": r.get('title'),
-                            "description": r.get('description'),
-                            "ingredients": r.get('ingredients', [])[:30],
-                            "instructions": r.get('instructions', [])[:12],
-                        }
-                        for r in recipes[:2]
-                    ],
-                }
-                prompt_parts.append(
-                    "Past scan context (JSON): " + json.dumps(scan_context, ensure_ascii=False)
-                )
-
-        prompt_parts.append("User message: " + message)
-        full_prompt = "\n\n".join(prompt_parts)
+        # Scan context is only attached for logged-in users
+        username = user.get('username') if user.get('is_logged_in') else None
+        conversation = load_conversation(
+            request.form.get('conversation_id'), username, scan_id if username else None
+        )
 
-        # Optional image
-        contents = [full_prompt]
+        # Optional image, attached to the conversation once
+        inline_image = None
+        sent_image = False
         if 'image' in request.files and request.files['image']:
             img_file = request.files['image']
             if img_file.filename:
-                image = Image.open(img_file)
-                contents = [full_prompt, image]
+                _, image_blob, _ = normalize_image(img_file.read())
+                inline_image = attach_conversation_image(conversation, image_blob)
+                sent_image = True
+
+        client, context_cached = chat_client_for(conversation)
+        contents = build_chat_contents(conversation, message, preferences, context_cached, inline_image)
+
+        wants_stream = (
+            request.form.get('stream') == '1'
+            or 'text/event-stream' in request.headers.get('Accept', '')
+        )
+        if wants_stream:
+            def stream():
+                yield from stream_chat_answer(
+                    contents,
+                    client=client,
+                    on_answer=lambda answer: record_chat_turn(conversation, message, answer, sent_image),
+                )
+                # After `done`, so the client isn't kept waiting on the summary
+                compact_conversation(conversation)
 
-        response = chat_model.generate_content(contents)
+            return Response(
+                stream_with_context(stream()),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
+
+        response = client.generate_content(contents)
         answer = (response.text or '').strip()
         if not answer:
             return jsonify({'error': 'No response from AI'}), 500
 
-        return jsonify({'answer': answer})
+        record_chat_turn(conversation, message, answer, sent_image)
+        reply = jsonify({'answer': answer, 'conversation_id': conversation["id"]})
+        # Once the reply is sent, like the stream, so the client isn't kept waiting on the summary
+        reply.call_on_close(lambda: compact_conversation(conversation))
+        return reply
+
+    except ImageTooLarge as e:
+        return jsonify({'error': f'Image is too large: {e}'}), 413
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
 
     except Exception as e:
         print(f"Chat API error: {e}")
@@ -542,51 +2559,33 @@ def analyze_image():
     # but we'll use the form data if available for simplicity in this flow.
     language = request.form.get('language', 'English')
     units = request.form.get('units', 'Metric')
-    prompt_language = "Български" if language == "Bulgarian" else "English"
 
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
 
     try:
-        image = Image.open(file)
+        image, image_blob, _ = normalize_image(file.read())
+        exact_hash, perceptual_hash = fingerprint_image(image)
 
-        # 1. Build the dynamic prompt including the settings
-        prompt = f"""
-        Analyze this image and identify the ingredients.
-        Based on these ingredients, suggest 2 distinct recipes.
-        
-        **CRITICAL INSTRUCTION: Generate the entire output (Title, Description, Ingredients, and Instructions) entirely in {prompt_language}.**
-        
-        SETTINGS:
-        - Units: Use the {units} system for all measurements (e.g. if Metric use grams/Celsius, if Imperial use cups/pounds/Fahrenheit).
-        
-        Return the response in the specific JSON format defined in your system instructions.
-        """
-        
-        # 2. Ask Gemini for recipes (THE ACTUAL API CALL)
-        response = model.generate_content([prompt, image])
-        
-        # Robust JSON parsing to handle malformed output from the model
-        try:
-            recipes = json.loads(response.text)
-        except json.JSONDecodeError as json_e:
-            # Print the faulty JSON to the Flask console for debugging
-            print("\n--- JSON PARSE ERROR ---")
-            print(f"Error: {json_e}")
-            print("Raw Model Output:")
-            print(response.text)
-            print("------------------------\n")
-            
-            return jsonify({
-                'error': f'The AI generated malformed output. Please try again with a clearer image or different settings. Details: {json_e.msg}'
-            }), 500
+        # Streaming variant: NDJSON events, one per recipe as soon as it is written
+        wants_stream = (
+            request.form.get('stream') == '1'
+            or 'application/x-ndjson' in request.headers.get('Accept', '')
+        )
+        if wants_stream:
+            return Response(
+                stream_with_context(stream_analysis(image_blob, exact_hash, perceptual_hash, language, units)),
+                mimetype='application/x-ndjson',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
 
-        # 3. Loop through recipes and fetch images
-        for recipe in recipes:
-            search_query = f"{recipe['title']} food dish"
-            recipe['image_url'] = get_recipe_image(search_query)
+        # Re-scans of the same photo with the same settings skip Gemini entirely
+        recipes, cached = analysis_cache.get_or_compute(
+            exact_hash, perceptual_hash, language, units,
+            lambda: generate_recipes(image_blob, language, units),
+        )
 
-        # 4. Save the full scan if the user is logged in
+        # Save the full scan if the user is logged in
         new_scan_id = None
         if session.get("logged_in"):
             if recipes and isinstance(recipes, list):
@@ -595,14 +2594,146 @@ def analyze_image():
         # Send back the recipes AND the new scan ID if available
         return jsonify({
             "recipes": recipes, 
-            "scan_id": new_scan_id 
+            "scan_id": new_scan_id,
+            "cached": cached,
         })
 
+    except ImageTooLarge as e:
+        return jsonify({'error': f'Image is too large: {e}'}), 413
+
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    except MalformedModelOutput as e:
+        return jsonify({
+            'error': f'The AI generated malformed output. Please try again with a clearer image or different settings. Details: {e}'
+        }), 500
+
     except Exception as e:
         print(f"Server Error: {e}")
         error_message = f'An internal error occurred: {str(e)}. Check your API key or image format.'
         return jsonify({'error': error_message}), 500
 
+@app.route('/analyze_jobs', methods=['POST'])
+def submit_analysis_job():
+    """Job mode for /analyze: returns a job id right away and analyzes in the background.
+
+    Poll GET /analyze_jobs/<job_id>, or subscribe to /analyze_jobs/<job_id>/events.
+    """
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    language = request.form.get('language', 'English')
+    units = request.form.get('units', 'Metric')
+
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+
+    try:
+        image, image_blob, _ = normalize_image(file.read())
+    except ImageTooLarge as e:
+        return jsonify({'error': f'Image is too large: {e}'}), 413
+    exact_hash, perceptual_hash = fingerprint_image(image)
+
+    username = session.get('username') if session.get('logged_in') else None
+    job_id = str(uuid.uuid4())
+    store.create_job(job_id, username)
+
+    accepted = analysis_jobs.submit(
+        job_id,
+        lambda: run_analysis_job(job_id, image_blob, exact_hash, perceptual_hash, language, units, username),
+    )
+    if not accepted:
+        store.update_job(job_id, status="error", finished_at=time.time(), error="Server busy")
+        response = jsonify({'error': 'Too many scans in progress. Please try again shortly.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(ANALYSIS_JOB_RETRY_AFTER_SECONDS)
+        return response
+
+    status_url = url_for('analysis_job_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': status_url}), 202, {'Location': status_url}
+
+
+def load_job(job_id):
+    """Loads a job, failing it first if it was orphaned and no heartbeat thread has noticed yet."""
+    job = store.get_job(job_id)
+    if job and job["status"] in ("queued", "running") and \
+            job["heartbeat_at"] < time.time() - ANALYSIS_JOB_ORPHANED_AFTER_SECONDS:
+        fail_orphaned_jobs(job_id)
+        job = store.get_job(job_id)
+    return job
+
+
+def get_own_job(job_id):
+    """Loads a job, hiding jobs that belong to another user."""
+    job = load_job(job_id)
+    if job is None:
+        return None
+    if job["username"] and job["username"] != session.get('username'):
+        return None
+    return job
+
+
+@app.route('/analyze_jobs/<job_id>')
+def analysis_job_status(job_id):
+    job = get_own_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job_view(job))
+
+
+@app.route('/analyze_jobs/<job_id>/events')
+def analysis_job_events(job_id):
+    """Server-Sent Events for one job: `status` on every change, then `done` or `error`.
+
+    This holds a worker for as long as the client listens, so plain polling is
+    the better fit for sync gunicorn workers.
+    """
+    if get_own_job(job_id) is None:
+        abort(404)
+
+    def events():
+        last_status = None
+        while True:
+            job = load_job(job_id)
+            if job is None:
+                yield sse_event("error", {"error": "Job expired"})
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield sse_event("status", {"status": last_status})
+            if job["status"] == "done":
+                yield sse_event("done", job_view(job))
+                return
+            if job["status"] == "error":
+                yield sse_event("error", job_view(job))
+                return
+            time.sleep(0.5)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+# -----------------------------------------------------
+# --- DIAGNOSTICS ---
+# -----------------------------------------------------
+
+@app.route('/stats')
+def stats_api():
+    """Cache counters for this worker (entries are shared across workers)."""
+    return jsonify({
+        "image_cache": image_cache.stats(),
+        "analysis_cache": analysis_cache.stats(),
+        "image_normalization": dict(normalization_totals),
+        "analysis_jobs": analysis_jobs.stats(),
+        "gemini": GeminiClient.stats(gemini_breaker),
+        "recipe_parsing": recipe_parse_summary(),
+        "chat": dict(chat_totals),
+    })
+
 if __name__ == '__main__':
     app.run(
         host="0.0.0.0",
@@ -0,0 +1,120 @@
+"""Read/write throughput of the storage backends.
+
+Usage:
+    python benchmarks/bench_storage.py [--backend sqlite|memory|both]
+        [--users 20] [--scans 200] [--processes 4]
+
+SQLite writes are run from several processes at once, the way gunicorn
+workers would hit the shared database file.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+import app  # noqa: E402
+
+
+def fake_scan(index):
+    recipes = [
+        {
+            "title": f"Recipe {index}-{n}",
+            "description": "A quick weeknight dish.",
+            "ingredients": ["2 eggs", "1 onion", "200 g tomatoes", "50 g cheese"],
+            "instructions": ["Chop everything.", "Cook for 10 minutes.", "Serve."],
+            "time_minutes": 20,
+            "skill_level": "Easy",
+            "image_url": "https://images.pexels.com/photos/1/pexels-photo-1.jpeg",
+        }
+        for n in range(2)
+    ]
+    return {
+        "date": "Jan 01, 2026",
+        "timestamp": time.time() + index * 1e-3,
+        "recipes": recipes,
+        "summary_title": recipes[0]["title"],
+        "summary_notes": recipes[0]["description"],
+        "summary_image": recipes[0]["image_url"],
+    }
+
+
+def write_worker(store_factory, usernames, scans_per_user, offset):
+    store = store_factory()
+    for username in usernames:
+        for index in range(scans_per_user):
+            store.add_scan(username, str(uuid.uuid4()), fake_scan(offset + index))
+
+
+def bench(name, store_factory, users, scans_per_user, processes):
+    store = store_factory()
+    usernames = [f"user{n}" for n in range(users)]
+    for username in usernames:
+        store.create_user(username, str(uuid.uuid4()), "hash")
+
+    total_writes = users * scans_per_user
+    started = time.perf_counter()
+    if processes > 1:
+        chunks = [usernames[n::processes] for n in range(processes)]
+        workers = [
+            multiprocessing.Process(target=write_worker, args=(store_factory, chunk, scans_per_user, n * scans_per_user))
+            for n, chunk in enumerate(chunks)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        write_worker(lambda: store, usernames, scans_per_user, 0)
+    write_seconds = time.perf_counter() - started
+
+    scan_ids = {username: [scan["id"] for scan in store.list_scans(username)] for username in usernames}
+
+    reads = 0
+    started = time.perf_counter()
+    for _ in range(5):
+        for username in usernames:
+            store.list_scans(username)
+            reads += 1
+    list_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    lookups = 0
+    for _ in range(total_writes):
+        username = random.choice(usernames)
+        store.get_scan(username, random.choice(scan_ids[username]))
+        lookups += 1
+    get_seconds = time.perf_counter() - started
+
+    print(f"{name}:")
+    print(f"  writes:     {total_writes / write_seconds:10.0f} scans/s  ({processes} process(es))")
+    print(f"  list_scans: {reads / list_seconds:10.0f} calls/s  ({scans_per_user} scans per user)")
+    print(f"  get_scan:   {lookups / get_seconds:10.0f} calls/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["sqlite", "memory", "both"], default="both")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--scans", type=int, default=200, help="scans per user")
+    parser.add_argument("--processes", type=int, default=4, help="concurrent SQLite writer processes")
+    args = parser.parse_args()
+
+    if args.backend in ("memory", "both"):
+        memory_store = app.MemoryStore()
+        bench("memory", lambda: memory_store, args.users, args.scans, processes=1)
+
+    if args.backend in ("sqlite", "both"):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.sqlite3")
+            bench("sqlite", lambda: app.SQLiteStore(path), args.users, args.scans, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Points the app at throwaway databases before it is imported."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+SCRATCH = tempfile.mkdtemp(prefix="cookai-tests-")
+
+os.environ.update({
+    "DATABASE_PATH": os.path.join(SCRATCH, "cookai.sqlite3"),
+    "RATE_LIMIT_PATH": os.path.join(SCRATCH, "rate_limits.sqlite3"),
+    "IMAGE_CACHE_PATH": os.path.join(SCRATCH, "image_cache.sqlite3"),
+    "GEMINI_API_KEY": "test",
+    "GEMINI_RETRY_BASE_SECONDS": "0",
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path, monkeypatch):
+    """A fresh store of each backend with user "alice", installed as app.store."""
+    if request.param == "memory":
+        store = app.MemoryStore()
+    else:
+        store = app.SQLiteStore(str(tmp_path / "store.sqlite3"))
+    store.create_user("alice", "1", "x")
+    monkeypatch.setattr(app, "store", store)
+    return store
+
+
+def recipe(title="Dish", *ingredients):
+    return {
+        "title": title, "description": "d", "ingredients": list(ingredients) or ["egg"], "instructions": ["cook"],
+        "time_minutes": 10, "skill_level": "Easy", "image_url": None,
+    }
+
+
+def scan(timestamp, title="Dish", *ingredients, **fields):
+    """A scan as the stores take it, with one recipe named `title`; `fields` override the rest."""
+    return {
+        "timestamp": timestamp, "date": "Jan 01, 1970", "summary_title": title, "summary_notes": "d",
+        "summary_image": None, "recipes": [recipe(title, *ingredients)],
+        **fields,
+    }
@@ -0,0 +1,96 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+RECIPES = [{"title": "Omelette", "description": "d", "ingredients": ["egg"], "instructions": ["cook"]}]
+
+
+def make_cache():
+    return app.AnalysisCache(16, ttl_seconds=60, max_distance=4)
+
+
+def test_identical_concurrent_calls_compute_once():
+    cache = make_cache()
+    calls = []
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return RECIPES
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(cache.get_or_compute, "hash", 1, "English", "Metric", compute) for _ in range(8)]
+        while cache.stats()["coalesced"] < 7:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert all(recipes == RECIPES for recipes, _ in results)
+    assert sorted(cached for _, cached in results) == [False] + [True] * 7
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_result_is_cached_before_leaving_in_flight_table():
+    cache = make_cache()
+    seen = []
+
+    def compute():
+        return RECIPES
+
+    original_store = cache._store
+
+    def store_and_check(*args):
+        original_store(*args)
+        # Still in flight while the entry lands, so no request can miss both
+        seen.append(("hash", "English", "Metric") in cache._in_flight)
+
+    cache._store = store_and_check
+    cache.get_or_compute("hash", 1, "English", "Metric", compute)
+    assert seen == [True]
+    assert cache.lookup("hash", 1, "English", "Metric") == RECIPES
+
+
+def test_failure_reaches_waiters_and_is_not_cached():
+    cache = make_cache()
+    started = threading.Event()
+
+    def compute():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("malformed")
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(cache.get_or_compute, "hash", 1, "English", "Metric", compute)
+        started.wait(5)
+        follower = pool.submit(cache.get_or_compute, "hash", 1, "English", "Metric", lambda: RECIPES)
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result()
+
+    assert cache.stats()["in_flight"] == 0
+    assert cache.get_or_compute("hash", 1, "English", "Metric", lambda: RECIPES) == (RECIPES, False)
+
+
+def test_interrupted_compute_leaves_no_stale_in_flight_entry():
+    cache = make_cache()
+
+    def compute():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        cache.get_or_compute("hash", 1, "English", "Metric", compute)
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_near_duplicate_photo_hits_by_perceptual_hash():
+    cache = make_cache()
+    cache.store("hash", 0b1010, "English", "Metric", RECIPES)
+    assert cache.lookup("other", 0b1011, "English", "Metric") == RECIPES
+    assert cache.lookup("other", 0b1011, "Bulgarian", "Metric") is None
+
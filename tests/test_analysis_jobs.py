@@ -0,0 +1,37 @@
+import threading
+import time
+
+import app
+
+
+def test_orphaned_jobs_fail_and_live_ones_do_not(store, monkeypatch):
+    monkeypatch.setattr(app, "ANALYSIS_JOB_HEARTBEAT_SECONDS", 0.05)
+    monkeypatch.setattr(app, "ANALYSIS_JOB_ORPHANED_AFTER_SECONDS", 0.4)
+    # A job whose worker went away: created, never submitted to a queue here
+    store.create_job("orphan", "alice")
+    store.update_job("orphan", status="running", started_at=time.time())
+
+    queue = app.AnalysisJobQueue(1, 1)
+    release = threading.Event()
+    store.create_job("live", "alice")
+    assert queue.submit("live", lambda: release.wait(5))
+    try:
+        deadline = time.time() + 5
+        while store.get_job("orphan")["status"] != "error" and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)  # Past the live job's own orphan cutoff
+        assert store.get_job("orphan")["error"] == app.ORPHANED_JOB_ERROR
+        assert store.get_job("live")["status"] == "queued"  # Its body never updates the row
+        assert queue.stats()["orphaned"] == 1
+    finally:
+        release.set()
+
+
+def test_status_read_fails_an_orphaned_job(store, monkeypatch):
+    monkeypatch.setattr(app, "ANALYSIS_JOB_ORPHANED_AFTER_SECONDS", 0)
+    store.create_job("orphan", None)
+    time.sleep(0.01)
+    with app.app.test_request_context():
+        job = app.get_own_job("orphan")
+    assert job["status"] == "error"
+    assert job["finished_at"] is not None
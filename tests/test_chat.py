@@ -0,0 +1,45 @@
+import time
+
+import app
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class ChatModel:
+    def __init__(self):
+        self.prompts = []
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        self.prompts.append(contents)
+        return Reply("Summary of the chat." if isinstance(contents, str) else "Use ricotta instead.")
+
+
+def test_conversation_is_compacted_after_the_reply_is_sent(monkeypatch):
+    model = ChatModel()
+    monkeypatch.setattr(app.chat_model, "model", model)
+    monkeypatch.setattr(app, "CHAT_TOKEN_BUDGET", 1)
+    monkeypatch.setattr(app, "CHAT_KEEP_RECENT_TURNS", 1)
+    client = app.app.test_client()
+
+    conversation_id = client.post("/chat_api", data={"message": "What can I cook?"}).get_json()["conversation_id"]
+    with client.post("/chat_api", data={"message": "No cheese?", "conversation_id": conversation_id}) as reply:
+        assert reply.get_json()["answer"] == "Use ricotta instead."
+        compactions = sum(isinstance(prompt, str) for prompt in model.prompts)
+    assert sum(isinstance(prompt, str) for prompt in model.prompts) == compactions + 1
+    assert app.store.get_conversation(conversation_id)["summary"] == "Summary of the chat."
+
+
+def test_lru_cache_bounds_entries_and_expires_them(monkeypatch):
+    cache = app.LRUCache(2, ttl_seconds=60)
+    for key in "abc":
+        cache.put(key, key.upper())
+    assert cache.get("a") is None and cache.get("c") == "C"
+
+    now = time.monotonic()
+    monkeypatch.setattr(app.time, "monotonic", lambda: now + 61)
+    assert cache.get("c") is None
+    assert cache.stats()["entries"] == 1
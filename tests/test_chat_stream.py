@@ -0,0 +1,89 @@
+import json
+
+import app
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class NoText:
+    @property
+    def text(self):
+        raise ValueError("no text parts")  # Like the SDK's final finish_reason chunk
+
+
+class Stream:
+    usage_metadata = None
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    def __iter__(self):
+        yield from self.chunks
+        if self.error:
+            raise self.error
+
+
+class Client:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        return self.stream
+
+
+def frames(events):
+    """(event, payload) for each SSE frame."""
+    parsed = []
+    for frame in "".join(events).split("\n\n")[:-1]:
+        event, data = frame.split("\n")
+        parsed.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return parsed
+
+
+def test_sse_frames_keep_newlines_inside_the_data_line():
+    assert app.sse_event("token", {"text": "Шопска\nсалата"}) == (
+        'event: token\ndata: {"text": "Шопска\\nсалата"}\n\n'
+    )
+
+
+def test_answer_streams_tokens_then_done(monkeypatch):
+    stream = Stream([Chunk("Use "), NoText(), Chunk(""), Chunk("ricotta. ")])
+    monkeypatch.setattr(app, "chat_model", Client(stream))
+    assert frames(app.stream_chat_answer(["prompt"])) == [
+        ("token", {"text": "Use "}), ("token", {"text": "ricotta. "}), ("done", {}),
+    ]
+
+
+def test_empty_answer_is_an_error_event(monkeypatch):
+    monkeypatch.setattr(app, "chat_model", Client(Stream([NoText()])))
+    assert frames(app.stream_chat_answer(["prompt"])) == [("error", {"error": "No response from AI"})]
+
+
+def test_failure_mid_stream_ends_with_an_error_event(monkeypatch):
+    monkeypatch.setattr(app, "chat_model", Client(Stream([Chunk("Use ")], error=RuntimeError("connection reset"))))
+    assert frames(app.stream_chat_answer(["prompt"])) == [
+        ("token", {"text": "Use "}), ("error", {"error": "Chat failed: connection reset"}),
+    ]
+
+
+def test_upstream_refusal_mid_stream_carries_retry_after(monkeypatch):
+    stream = Stream([Chunk("Use ")], error=app.UpstreamUnavailable("Gemini is over quota", 2.5))
+    monkeypatch.setattr(app, "chat_model", Client(stream))
+    assert frames(app.stream_chat_answer(["prompt"])) == [
+        ("token", {"text": "Use "}), ("error", {"error": "Gemini is over quota", "retry_after": 3}),
+    ]
+
+
+def test_chat_api_streams_when_asked(monkeypatch):
+    monkeypatch.setattr(app, "chat_model", Client(Stream([Chunk("Use "), Chunk("ricotta.")])))
+    client = app.app.test_client()
+
+    reply = client.post("/chat_api", data={"message": "No cheese?"}, headers={"Accept": "text/event-stream"})
+    assert reply.mimetype == "text/event-stream"
+    assert reply.headers["Cache-Control"] == "no-cache" and reply.headers["X-Accel-Buffering"] == "no"
+    events = frames([reply.get_data(as_text=True)])
+    assert [event for event, _ in events] == ["token", "token", "done"]
@@ -0,0 +1,156 @@
+import time
+
+import google.api_core.exceptions
+import pytest
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, total_tokens=None):
+        self.usage_metadata = None
+        if total_tokens is not None:
+            self.usage_metadata = type("Usage", (), {"total_token_count": total_tokens})()
+
+
+class FakeModel:
+    """Answers with the given outcomes in turn: a response, or an exception to raise."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def _next(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        return self._next()
+
+
+class FailingLimiter:
+    def acquire(self, *args):
+        raise app.UpstreamUnavailable("limited", retry_after=1)
+
+
+class OpenLimiter:
+    def __init__(self):
+        self.acquired = []
+        self.adjusted = []
+
+    def acquire(self, name, amount, per_minute, max_wait):
+        self.acquired.append(name)
+        return 0.0
+
+    def adjust(self, name, amount, per_minute):
+        self.adjusted.append((name, amount))
+
+
+def unavailable():
+    return google.api_core.exceptions.ServiceUnavailable("overloaded")
+
+
+def half_open_breaker():
+    breaker = app.CircuitBreaker(threshold=1, cooldown_seconds=60)
+    breaker.record_failure()
+    breaker.opened_at = time.time() - 61
+    assert breaker.state == "half_open"
+    return breaker
+
+
+def test_breaker_opens_after_threshold_and_probes_once():
+    breaker = app.CircuitBreaker(threshold=2, cooldown_seconds=60)
+    assert breaker.before_call() is False
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(app.UpstreamUnavailable):
+        breaker.before_call()
+
+    breaker.opened_at = time.time() - 61
+    assert breaker.before_call() is True
+    with pytest.raises(app.UpstreamUnavailable):
+        breaker.before_call()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = half_open_breaker()
+    assert breaker.before_call() is True
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_probe_released_when_limiter_refuses():
+    breaker = half_open_breaker()
+    client = app.GeminiClient("test", FakeModel(FakeResponse()), FailingLimiter(), breaker)
+    with pytest.raises(app.UpstreamUnavailable):
+        client.generate_content("hi")
+    assert not breaker.probe_in_flight
+    assert client.model.calls == 0
+    assert breaker.before_call() is True
+
+
+def test_every_retry_takes_limiter_tokens():
+    limiter = OpenLimiter()
+    model = FakeModel(unavailable(), FakeResponse(total_tokens=50))
+    client = app.GeminiClient("test", model, limiter, app.CircuitBreaker(10, 60))
+    client.generate_content("hi")
+    assert limiter.acquired.count("gemini_requests") == 2
+    assert limiter.acquired.count("gemini_tokens") == 2
+    assert limiter.adjusted == [("gemini_tokens", 50 - app.estimate_tokens("hi"))]
+
+
+def test_stream_outcome_recorded_when_stream_ends():
+    breaker = half_open_breaker()
+    limiter = OpenLimiter()
+    client = app.GeminiClient("test", None, limiter, breaker)
+
+    def broken_stream():
+        yield FakeResponse()
+        raise unavailable()
+
+    client.model = FakeModel(broken_stream())
+    stream = client.generate_content("hi", stream=True)
+    assert breaker.probe_in_flight  # not judged at stream open
+    with pytest.raises(google.api_core.exceptions.ServiceUnavailable):
+        list(stream)
+    assert breaker.state == "open"
+
+    breaker.opened_at = time.time() - 61
+    client.model = FakeModel(iter([FakeResponse()]))
+    list(client.generate_content("hi", stream=True))
+    assert breaker.state == "closed"
+
+
+def test_abandoned_stream_releases_probe():
+    breaker = half_open_breaker()
+    client = app.GeminiClient("test", FakeModel(iter([FakeResponse(), FakeResponse()])), OpenLimiter(), breaker)
+    chunks = iter(client.generate_content("hi", stream=True))
+    next(chunks)
+    chunks.close()
+    assert not breaker.probe_in_flight
+    assert breaker.state == "half_open"
+
+
+def test_limiter_refuses_beyond_max_wait(tmp_path):
+    limiter = app.SharedTokenBucket(str(tmp_path / "buckets.sqlite3"))
+    assert limiter.acquire("requests", 1, 2, max_wait=0) == 0.0
+    assert limiter.acquire("requests", 1, 2, max_wait=0) == 0.0
+    with pytest.raises(app.UpstreamUnavailable) as refused:
+        limiter.acquire("requests", 1, 2, max_wait=1)
+    assert refused.value.retry_after == pytest.approx(30, abs=1)
+
+
+def test_limiter_adjust_refunds_tokens(tmp_path):
+    limiter = app.SharedTokenBucket(str(tmp_path / "buckets.sqlite3"))
+    limiter.acquire("tokens", 100, 100, max_wait=0)
+    with pytest.raises(app.UpstreamUnavailable):
+        limiter.acquire("tokens", 1, 100, max_wait=0)
+    limiter.adjust("tokens", -50, 100)
+    assert limiter.acquire("tokens", 1, 100, max_wait=0) == 0.0
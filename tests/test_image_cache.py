@@ -0,0 +1,96 @@
+import sqlite3
+
+import app
+
+
+def make_cache(tmp_path, max_entries=5):
+    return app.ImageCache(str(tmp_path / "images.sqlite3"), max_entries, ttl_seconds=60, negative_ttl_seconds=10)
+
+
+class Answer:
+    def __init__(self, query):
+        self.query = query
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"photos": [{"src": {"medium": f"https://images.pexels.com/{self.query}.jpg"}}]}
+
+
+class NoPhotos(Answer):
+    def json(self):
+        return {"photos": []}
+
+
+class Pexels:
+    def __init__(self, answer=Answer):
+        self.queries = []
+        self.answer = answer
+
+    def get(self, url, params=None, **kwargs):
+        self.queries.append(params["query"])
+        return self.answer(params["query"])
+
+
+class BrokenConnection:
+    def execute(self, *args):
+        raise sqlite3.OperationalError("disk I/O error")
+
+
+def clock(monkeypatch, start=1000.0):
+    now = [start]
+    monkeypatch.setattr(app.time, "time", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_their_ttl(tmp_path, monkeypatch):
+    now = clock(monkeypatch)
+    cache = make_cache(tmp_path)
+    cache.set("Leek Soup food dish", "https://images.pexels.com/leek.jpg")
+    assert cache.get("leek  soup") == "https://images.pexels.com/leek.jpg"  # Same normalized query
+    now[0] += 61
+    assert cache.get("Leek Soup food dish") is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_dishes_without_a_photo_are_cached_for_the_shorter_ttl(tmp_path, monkeypatch):
+    now = clock(monkeypatch)
+    cache = make_cache(tmp_path)
+    monkeypatch.setattr(app, "image_cache", cache)
+    monkeypatch.setattr(app, "PEXELS_API_KEY", "test")
+    pexels = Pexels(NoPhotos)
+    monkeypatch.setattr(app, "pexels_session", pexels)
+
+    assert app.get_recipe_image("Durian Stew food dish") == app.NO_IMAGE_FOUND_URL
+    now[0] += 5
+    assert app.get_recipe_image("Durian Stew food dish") == app.NO_IMAGE_FOUND_URL
+    assert len(pexels.queries) == 1
+    now[0] += 6  # Past the 10 s negative TTL, well before the 60 s one
+    app.get_recipe_image("Durian Stew food dish")
+    assert len(pexels.queries) == 2
+
+
+def test_eviction_runs_every_few_writes(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    monkeypatch.setattr(cache, "evict_every", 4)
+    for n in range(7):
+        cache.set(f"dish {n}", f"https://images.pexels.com/{n}.jpg")
+    assert cache.stats()["entries"] == 7  # over the bound until the next eviction
+    cache.set("dish 7", "https://images.pexels.com/7.jpg")
+    assert cache.stats()["entries"] == 5
+    assert cache.get("dish 7") and cache.get("dish 0") is None
+
+
+def test_broken_cache_degrades_to_uncached_lookups(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    monkeypatch.setattr(cache, "_connection", BrokenConnection)
+    monkeypatch.setattr(app, "image_cache", cache)
+    monkeypatch.setattr(app, "PEXELS_API_KEY", "test")
+    pexels = Pexels()
+    monkeypatch.setattr(app, "pexels_session", pexels)
+
+    url = app.get_recipe_image("Leek Soup food dish")
+    assert url == "https://images.pexels.com/Leek Soup food dish.jpg"
+    assert pexels.queries == ["Leek Soup food dish"]
+    assert cache.errors == 2
@@ -0,0 +1,52 @@
+import io
+import warnings
+
+import pytest
+from PIL import Image
+
+import app
+
+
+def encode(image, image_format, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+def test_photos_are_downscaled_and_reencoded(monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_MAX_EDGE", 512)
+    data = encode(Image.new("RGBA", (2000, 1000), (200, 40, 40, 128)), "PNG")
+
+    image, blob, stats = app.normalize_image(data)
+
+    assert image.mode == "RGB" and image.size == (512, 256)
+    assert blob["mime_type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(blob["data"])).size == (512, 256)
+    assert stats == {"bytes_in": len(data), "bytes_out": len(blob["data"]), "pixels_in": 2_000_000, "pixels_out": 131_072}
+
+
+def test_exif_orientation_is_applied():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90°: stored landscape, shown portrait
+    data = encode(Image.new("RGB", (80, 40), "green"), "JPEG", exif=exif)
+
+    image, _, _ = app.normalize_image(data)
+    assert image.size == (40, 80)
+
+
+@pytest.mark.parametrize("size", [(40, 40), (100, 100)])  # Over our limit, and over Pillow's bomb check
+def test_oversized_photos_are_refused_before_decoding(monkeypatch, size):
+    monkeypatch.setattr(app, "IMAGE_MAX_PIXELS", 1000)
+    data = encode(Image.new("RGB", size, "white"), "PNG")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        with pytest.raises(app.ImageTooLarge):
+            app.normalize_image(data)
+
+
+def test_analyze_answers_oversized_photos_with_413(monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_MAX_PIXELS", 1000)
+    data = encode(Image.new("RGB", (100, 100), "white"), "PNG")
+    reply = app.app.test_client().post("/analyze", data={"image": (io.BytesIO(data), "photo.png")})
+    assert reply.status_code == 413
+    assert reply.get_json()["error"].startswith("Image is too large")
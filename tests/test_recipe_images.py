@@ -0,0 +1,29 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+
+def test_one_deadline_for_the_whole_stage(monkeypatch):
+    pool = ThreadPoolExecutor(2)
+    started = []
+    lock = threading.Lock()
+
+    def slow_lookup(query):
+        with lock:
+            started.append(query)
+        time.sleep(0.3)
+        return f"https://images.test/{query}"
+
+    monkeypatch.setattr(app, "image_lookup_pool", pool)
+    monkeypatch.setattr(app, "get_recipe_image", slow_lookup)
+    monkeypatch.setattr(app, "PEXELS_TIMEOUT_SECONDS", 0.45)
+    recipes = [{"title": f"Dish {n}"} for n in range(8)]
+
+    elapsed_ms = app.fetch_recipe_images(recipes)
+    pool.shutdown(wait=True)
+
+    assert elapsed_ms < 600  # Not one timeout per "wave" of two lookups
+    assert [recipe["image_url"].startswith("https://images.test/") for recipe in recipes] == [True] * 2 + [False] * 6
+    assert len(started) == 4  # The lookups queued behind the deadline were cancelled
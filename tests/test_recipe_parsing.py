@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import app
+
+RECIPE = {
+    "title": "Omelette", "description": "Quick", "ingredients": ["2 eggs"], "instructions": ["Whisk", "Fry"],
+    "time_minutes": 10, "skill_level": "Easy",
+}
+
+
+def test_relax_json_drops_comments_and_trailing_commas_outside_strings():
+    text = '[{"title": "A // not a comment", "tags": ["x", "y",], // note\n "n": 1,},]'
+    assert json.loads(app.relax_json(text)) == [{"title": "A // not a comment", "tags": ["x", "y"], "n": 1}]
+    assert app.relax_json('{"s": "a,}"}') == '{"s": "a,}"}'
+
+
+def test_parse_recipes_clean_output():
+    assert app.parse_recipes(json.dumps([RECIPE])) == [RECIPE]
+    assert app.parse_recipes("```json\n" + json.dumps({"recipes": [RECIPE]}) + "\n```") == [RECIPE]
+
+
+def test_parse_recipes_keeps_complete_objects_of_truncated_output():
+    second = {**RECIPE, "title": "Pancakes"}
+    text = json.dumps([RECIPE, second])[:-40]
+    assert [recipe["title"] for recipe in app.parse_recipes(text)] == ["Omelette"]
+
+
+def test_parse_recipes_repairs_trailing_commas():
+    text = json.dumps([RECIPE]).replace('"Fry"]', '"Fry",]').replace("}]", "},]")
+    assert app.parse_recipes(text) == [RECIPE]
+
+
+def test_parse_recipes_raises_when_nothing_is_usable():
+    with pytest.raises(app.MalformedModelOutput):
+        app.parse_recipes('[{"title": "Half')
+    with pytest.raises(app.MalformedModelOutput):
+        app.parse_recipes(json.dumps([{"title": "No steps", "ingredients": ["egg"]}]))
+
+
+def test_stream_parser_yields_objects_as_they_complete_and_drops_malformed_ones():
+    parser = app.RecipeStreamParser()
+    assert parser.feed('[{"title": "Bro') == []
+    assert parser.partial_title() is None
+    assert parser.feed('ken", "ingredients": [1 2]}, {"title": "Sal') == []  # Not JSON even relaxed
+    assert parser.partial_title() is None
+    assert parser.feed('ad \\"Nice\\"", "n": [1,],') == []
+    assert parser.partial_title() == 'Salad "Nice"'
+    assert parser.feed(' "s": "}"}]') == [{"title": 'Salad "Nice"', "n": [1], "s": "}"}]
+
+
+def test_validate_recipe_cleans_fields():
+    cleaned = app.validate_recipe({
+        "title": "  Soup ", "ingredients": ["leek", "", 2, None], "instructions": ["Boil"],
+        "time_minutes": "about 25 min", "skill_level": "hard", "image_url": "u",
+    })
+    assert cleaned == {
+        "title": "Soup", "description": "", "ingredients": ["leek", "2"], "instructions": ["Boil"],
+        "time_minutes": 25, "skill_level": "Hard", "image_url": "u",
+    }
+    assert app.validate_recipe({**RECIPE, "time_minutes": 12.6, "skill_level": "Expert"})["time_minutes"] == 13
+    assert app.validate_recipe({**RECIPE, "skill_level": "Expert"})["skill_level"] == "Medium"
+    assert app.validate_recipe({**RECIPE, "time_minutes": True})["time_minutes"] == 0
+
+
+@pytest.mark.parametrize("recipe", [
+    None, [], {**RECIPE, "title": " "}, {**RECIPE, "ingredients": []}, {**RECIPE, "instructions": "Stir"},
+])
+def test_validate_recipe_rejects_unusable_recipes(recipe):
+    assert app.validate_recipe(recipe) is None
+
+
+def test_streamed_analysis_asks_for_the_recipe_schema(monkeypatch):
+    calls = []
+
+    class Model:
+        def generate_content(self, contents, stream=False, **kwargs):
+            calls.append((stream, kwargs["generation_config"]))
+            return iter([])
+
+    monkeypatch.setattr(app.model, "model", Model())
+    with app.app.test_request_context():
+        list(app.stream_analysis(b"photo", "exact", None, "English", "Metric"))
+    assert calls == [(True, {"response_schema": app.RECIPE_LIST_SCHEMA})]
@@ -0,0 +1,34 @@
+import json
+
+import app
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class StreamingModel:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        return iter([Chunk(text) for text in self.chunks])
+
+
+def test_image_lookup_follows_the_title_past_a_dropped_object(monkeypatch):
+    monkeypatch.setattr(app, "model", StreamingModel([
+        '[{"title": "Broken Soup", "ingredients": [,,,',
+        ']}, {"title": "Green Salad", "description": "d",',
+        ' "ingredients": ["lettuce"], "instructions": ["toss"]}]',
+    ]))
+    monkeypatch.setattr(app, "get_recipe_image", lambda query: f"https://img.test/{query}")
+
+    with app.app.test_request_context():
+        events = [json.loads(line) for line in app.stream_analysis(b"photo", "exact", None, "English", "Metric")]
+
+    recipes = [event["recipe"] for event in events if event["type"] == "recipe"]
+    images = {event["index"]: event["image_url"] for event in events if event["type"] == "image"}
+    assert [recipe["title"] for recipe in recipes] == ["Green Salad"]
+    assert (recipes[0]["image_url"] or images[0]) == "https://img.test/Green Salad food dish"
+    assert events[-1]["type"] == "done"